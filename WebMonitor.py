@@ -1,34 +1,105 @@
 # Python modules.
+import asyncio
+import base64
+import binascii
+import csv
 import datetime
-import pandas as pd
+import io
+import json
+import os
+import time
+from contextlib import asynccontextmanager
 import numerize.numerize
 # FastAPI modules.
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, UploadFile, HTTPException, WebSocket, Query
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import RedirectResponse, StreamingResponse
+from fastapi.responses import JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 
 from typing import Optional
 
 # Own Modules
 import database
-import data_tratment
+import metrics
+import stats
+from grid_channel import GridChannel
+from mosaic import DEFAULT_COLUMNS, DEFAULT_TILE_WIDTH, layout_info, normalize_layout
+from ingest import IngestQueue
+from registry import BotRegistry
+from retention import RetentionJob
+from timeseries import METRICS, RESOLUTIONS, TelemetryStore
+from frame_store import FrameTooLarge, SharedMemoryFrameStore
 from streamer import FrameStreamer
 from schemas.login import LoginSchema
 from schemas.image import InputImgSchema
-
-web_monitor = FastAPI()
+from schemas.transaction import TransactionBatchSchema
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Abre el pool de conexiones al iniciar y lo cierra al apagar el servidor
+    await database.init()
+    await bot_registry.load()
+    await ingest_queue.start()
+    await telemetry.start()
+    await retention_job.start()
+    loop_lag_task = asyncio.create_task(loop_lag.run())
+    yield
+    loop_lag_task.cancel()
+    await retention_job.stop()
+    await telemetry.stop()
+    # La cola se vacía antes de cerrar el pool para no perder transacciones
+    await ingest_queue.stop()
+    await database.close()
+    fs.close()
+
+
+web_monitor = FastAPI(lifespan=lifespan)
+# Latencia por ruta en /metrics (subsistema "http")
+web_monitor.add_middleware(metrics.RequestMetricsMiddleware, subsystem=metrics.registry.subsystem("http"))
 web_monitor.mount("/styles", StaticFiles(directory="styles"), name="styles")
 web_monitor.mount("/js", StaticFiles(directory="js"), name="js")
 web_monitor.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
-fs = FrameStreamer()
+# Con FRAME_STORE_PATH (p. ej. /dev/shm/albion_frames) las imágenes se guardan en memoria compartida
+# y todos los procesos del equipo ven las de los demás. Es lo único compartido: el registro de bots,
+# la caché de ids, la caché de estadísticas y su ETag, la cola de ingesta y la telemetría son de cada
+# proceso, así que con uvicorn --workers N un worker no ve los bots registrados en otro y puede
+# responder 304 o 404 con datos viejos. Ver la sección "Varios procesos" del README.
+FRAME_STORE_PATH = os.environ.get("FRAME_STORE_PATH")
+# Solo los bots registrados tienen su propia serie en /metrics
+fs = FrameStreamer(SharedMemoryFrameStore(FRAME_STORE_PATH) if FRAME_STORE_PATH else None,
+                   known_stream=lambda name: name in bot_registry)
+FRAME_CONTENT_TYPES = ("image/jpeg", "image/png", "application/octet-stream")
+# Primeros bytes de un JPEG y de un PNG; lo demás se rechaza antes de guardarlo
+FRAME_MAGIC = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n")
+# Segundos sin cambios en la pantalla de un bot (que sigue enviando imágenes) para considerarlo atascado
+STUCK_AFTER = 60
+ingest_queue = IngestQueue()
+telemetry = TelemetryStore()
+bot_registry = BotRegistry(ingest_queue, telemetry)
+retention_job = RetentionJob()
+# Ventana por defecto de /api/telemetry, en segundos
+TELEMETRY_WINDOW = 3600
+grid_channel = GridChannel(fs, database.bot_ids.names, lambda: database.bot_ids.version, bot_registry.online_names)
+loop_lag = metrics.LoopLagMonitor(metrics.registry.subsystem("loop"))
+# Valores que se leen al momento de exportar /metrics, sin costo en el camino crítico
+INGEST_METRICS = metrics.registry.subsystem("ingest")
+INGEST_METRICS.gauge("ingest_queue_depth", "Events waiting in the ingest queue", function=ingest_queue.depth)
+INGEST_METRICS.counter("ingest_events_total", "Events accepted by the ingest queue",
+                       function=lambda: ingest_queue.stats.enqueued)
+INGEST_METRICS.counter("ingest_transactions_total", "Transactions written by the ingest queue",
+                       function=lambda: ingest_queue.stats.transactions)
+INGEST_METRICS.counter("ingest_failed_batches_total", "Ingest batches that could not be written",
+                       function=lambda: ingest_queue.stats.failed_batches)
+metrics.registry.subsystem("streams").gauge("grid_clients", "Clients connected to /ws/grid",
+                                            function=lambda: grid_channel.clients)
 
 
 @web_monitor.get("/")
-async def frontend(request: Request):
-    bots = await database.fetch_all_bots()
-    bots = sorted(bots, key=lambda x: x['name'])
+async def frontend(request: Request, mode: Optional[str] = None,
+                   columns: int = Query(DEFAULT_COLUMNS, gt=0), tile_width: int = Query(DEFAULT_TILE_WIDTH, gt=0)):
+    bots = bot_registry.bots()
     images_url = dict()
     for bot in bots:
         local_ip = bot['local_ip']
@@ -41,7 +112,8 @@ async def frontend(request: Request):
 
     return templates.TemplateResponse(
         "home.html",
-        {"request": request, "bots": bots, "images_url": images_url},
+        {"request": request, "bots": bots, "images_url": images_url,
+         "mosaic": mode == "mosaic", "columns": columns, "tile_width": tile_width},
         headers=header
     )
 
@@ -50,52 +122,77 @@ async def frontend(request: Request):
 @web_monitor.get("/bot_details/{bot_name}")
 async def bot_details(request: Request, bot_name: Optional[str] = None):
     # Si bot_name es None, obtendremos los detalles de todos los bots
-    details = await database.fetch_bot_details(bot_name) if bot_name else {}
-
-    current_year = datetime.datetime.now().year
-    # Si bot_name es None, devolverá las transacciones de todos los bots
-    transactions = await database.fetch_transactions_by_year(current_year, bot_name)
-
-    total_this_year, avg = data_tratment.calculate_total_per_month(transactions)
-    clp_avg = round(avg / 1000000 * 450)
-
-    if len(list(total_this_year.values())) > 0:
-        last_month_silver = list(total_this_year.values())[-1]
-        date_now = datetime.datetime.now()
-        # Mismo comportamiento para las transacciones del mes
-        data_this_month = await database.fetch_transactions_by_month(
-            date_now.year, date_now.month, bot_name, group_by_day=True
-        )
-        first_entry_day = pd.to_datetime(data_this_month.iloc[0].date).day
-
-        try:
-            avg_this_month = last_month_silver / (datetime.datetime.now().day - first_entry_day)
-        except ZeroDivisionError:
-            avg_this_month = 0
-    else:
-        avg_this_month = 0
-        data_this_month = pd.DataFrame()
-
-    # Numerize
-    avg = numerize.numerize.numerize(avg)
-    avg_this_month = numerize.numerize.numerize(avg_this_month)
+    details = bot_registry.get(bot_name) if bot_name else {}
+    if details is None:
+        raise HTTPException(status_code=404, detail=f"Unknown bot {bot_name}")
+
+    # Si bot_name es None, se calculan las estadísticas de todos los bots
+    bot_stats = await stats.cached_bot_stats(bot_name)
+
+    # Bots que siguen enviando imágenes pero cuya pantalla no cambia
+    status = fs.stream_status(STUCK_AFTER)
+    stuck_bots = {name: s["unchanged_for"] for name, s in status.items() if s["stuck"]}
 
     template = "bot_details.html" if bot_name else "dashboard.html"
 
     return templates.TemplateResponse(template, {
         "request": request,
         "details": details,
-        "total_this_year": total_this_year,
-        "avg_year": avg,
-        "clp_avg_year": clp_avg,
-        "avg_this_month": avg_this_month,
-        "data_this_month": data_this_month
+        "avg_year": numerize.numerize.numerize(bot_stats.avg_year),
+        "clp_avg_year": bot_stats.clp_avg_year,
+        "avg_this_month": numerize.numerize.numerize(bot_stats.avg_this_month),
+        "stuck_bots": stuck_bots
+    })
+
+
+async def conditional_stats(request: Request, bot: Optional[str], year: Optional[int], month: Optional[int], payload):
+    """
+        Responde 304 si el cliente ya tiene la versión actual de los datos; si no, calcula payload(stats).
+
+        El ETag cambia con cada transacción nueva (o cambio de totales) y con el día de referencia,
+        del que depende el promedio diario.
+    """
+    day = stats.reference_day(year, month)
+    # Un período futuro no tiene datos y se responde vacío
+    period = day.isoformat() if day else f"{year}-{month or 0}-future"
+    etag = f'"{database.data_version()}-{period}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    bot_stats = await stats.cached_bot_stats(bot, year, month)
+    return JSONResponse(payload(bot_stats), headers=headers)
+
+
+@web_monitor.get("/api/stats/monthly")
+async def api_monthly_stats(request: Request, bot: Optional[str] = None,
+                            year: Optional[int] = Query(None, ge=1, le=9999)):
+    # Totales por mes del año (de un bot o de toda la granja)
+    return await conditional_stats(request, bot, year, None, lambda s: [m._asdict() for m in s.monthly])
+
+
+@web_monitor.get("/api/stats/daily")
+async def api_daily_stats(request: Request, bot: Optional[str] = None, year: Optional[int] = Query(None, ge=1, le=9999),
+                          month: Optional[int] = Query(None, ge=1, le=12)):
+    # Totales por día del mes
+    return await conditional_stats(request, bot, year, month, lambda s: [d._asdict() for d in s.daily])
+
+
+@web_monitor.get("/api/stats/summary")
+async def api_summary_stats(request: Request, bot: Optional[str] = None):
+    # Promedios que se muestran en las tarjetas de resumen
+    return await conditional_stats(request, bot, None, None, lambda s: {
+        "total_this_year": sum(m.quantity for m in s.monthly),
+        "avg_year": s.avg_year,
+        "avg_year_display": numerize.numerize.numerize(s.avg_year),
+        "clp_avg_year": s.clp_avg_year,
+        "avg_this_month": s.avg_this_month,
+        "avg_this_month_display": numerize.numerize.numerize(s.avg_this_month),
     })
 
 
 @web_monitor.put("/update_temp/{bot_name}/{new_temp}")
 async def update_temp(bot_name: str, new_temp: int):
-    await database.update_temp(bot_name, new_temp)
+    await bot_registry.update_temp(bot_name, new_temp)
 
 
 @web_monitor.post("/add")
@@ -103,34 +200,184 @@ async def add(request: Request):
     form_data = await request.form()
     name = form_data['name']
     ip = form_data['ip']
-    await database.insert_bot(name, ip, 0, "Unknown")
+    await bot_registry.add(name, ip)
     return RedirectResponse("/", 303)
 
 
 @web_monitor.post("/delete/{name}")
 async def delete(name: str):
-    await database.delete_bot(name)
+    await bot_registry.remove(name)
+    fs.forget_stream(name)
     return RedirectResponse("/", 303)
 
 
 @web_monitor.put("/login_bot/{name}")
 async def login_bot(name: str, details: LoginSchema):
-    bot_id = await database.get_bot_id(name)
-    if bot_id is not None:
-        await database.update_bot(name, details.ip, details.temp, details.gathering_map)
-    else:
-        await database.insert_bot(name, details.ip, 0, details.gathering_map)
-        await database.insert_transaction(0, name)
+    await bot_registry.login(name, details.ip, details.temp, details.gathering_map)
+
+
+async def store_frame(stream_id: str, data: bytes, max_width: Optional[int] = None):
+    if not data.startswith(FRAME_MAGIC):
+        raise HTTPException(status_code=415, detail="Frame is not a JPEG or PNG image")
+    bot_registry.seen(stream_id, frame=True)
+    try:
+        await fs.send_frame(stream_id, data, max_width)
+    except FrameTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
 
 
 @web_monitor.post("/send_frame_from_string/{stream_id}")
 async def send_frame_from_string(stream_id: str, d: InputImgSchema):
-    await fs.send_frame(stream_id, d.img_base64str)
+    try:
+        data = base64.b64decode(d.img_base64str)
+    except binascii.Error:
+        raise HTTPException(status_code=400, detail="img_base64str is not valid base64")
+    await store_frame(stream_id, data)
+
+
+@web_monitor.post("/send_frame/{stream_id}")
+async def send_frame(stream_id: str, request: Request, max_width: Optional[int] = Query(None, gt=0)):
+    # El cuerpo es la imagen JPEG (o PNG) tal cual, sin base64 ni JSON
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type not in FRAME_CONTENT_TYPES:
+        raise HTTPException(status_code=415, detail=f"Expected one of {', '.join(FRAME_CONTENT_TYPES)}")
+    await store_frame(stream_id, await request.body(), max_width)
+
+
+@web_monitor.post("/send_frame_file/{stream_id}")
+async def send_frame_file(stream_id: str, file: UploadFile, max_width: Optional[int] = Query(None, gt=0)):
+    await store_frame(stream_id, await file.read(), max_width)
 
 
 @web_monitor.post("/add_transaction/{bot_name}/{quantity}")
 async def add_transaction(bot_name: str, quantity: int):
-    await database.insert_transaction(quantity, bot_name)
+    bot_registry.seen(bot_name)
+    await ingest_queue.add_transaction(bot_name, quantity)
+
+
+@web_monitor.post("/add_transactions")
+async def add_transactions(batch: TransactionBatchSchema):
+    # Lote de transacciones (de uno o varios bots) guardadas por los bots mientras no había conexión.
+    # Se escribe directo y no por la cola: el bot solo descarta su copia cuando recibe la respuesta.
+    transactions = list()
+    for t in batch.transactions:
+        date = t.date
+        # Las fechas se guardan en hora local sin zona horaria, igual que las de datetime.now()
+        if date is not None and date.tzinfo is not None:
+            date = date.astimezone().replace(tzinfo=None)
+        transactions.append((t.bot_name, t.quantity, date, t.idempotency_key))
+    inserted, duplicates = await database.insert_batch_transactions(transactions)
+    return {"inserted": inserted, "duplicates": duplicates}
+
+
+EXPORT_COLUMNS = ("id", "date", "bot", "quantity", "compacted")
+EXPORT_MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+async def csv_chunks(pages):
+    # Un chunk por página de database.iter_transactions, con el encabezado al inicio
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # El encabezado va aunque ninguna fila coincida con los filtros
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue()
+    async for rows in pages:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+
+async def ndjson_chunks(pages):
+    async for rows in pages:
+        yield "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n" for row in rows)
+
+
+@web_monitor.get("/export/transactions.{fmt}")
+async def export_transactions(fmt: str, bot: Optional[str] = None, start: Optional[datetime.date] = None,
+                              end: Optional[datetime.date] = None, min_quantity: Optional[int] = None):
+    # Historial completo o filtrado (fechas en [start, end)) en CSV o NDJSON, enviado por páginas
+    if fmt not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=404, detail=f"Unknown export format {fmt}, expected csv or ndjson")
+    bot_id = None
+    if bot:
+        bot_id = await database.get_bot_id(bot)
+        if bot_id is None:
+            raise HTTPException(status_code=404, detail=f"Unknown bot {bot}")
+    pages = database.iter_transactions(bot_id, start.isoformat() if start else None,
+                                       end.isoformat() if end else None, min_quantity)
+    chunks = csv_chunks(pages) if fmt == "csv" else ndjson_chunks(pages)
+    filename = f"transactions{'-' + bot if bot else ''}.{fmt}"
+    return StreamingResponse(chunks, media_type=EXPORT_MEDIA_TYPES[fmt],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+@web_monitor.get("/api/bots")
+async def api_bots():
+    # Estado en vivo de todos los bots, incluido online/offline según el último heartbeat
+    return bot_registry.bots()
+
+
+@web_monitor.get("/api/telemetry/{bot_name}")
+async def api_telemetry(bot_name: str, metric: str = "temp", start: Optional[float] = None,
+                        end: Optional[float] = None, resolution: Optional[str] = None):
+    # start y end son timestamps unix; por defecto la última hora. La resolución se elige según la ventana.
+    if metric not in METRICS:
+        raise HTTPException(status_code=400, detail=f"Expected metric in {', '.join(METRICS)}")
+    if resolution is not None and resolution not in [r[0] for r in RESOLUTIONS]:
+        raise HTTPException(status_code=400, detail=f"Expected resolution in {', '.join(r[0] for r in RESOLUTIONS)}")
+    if bot_registry.get(bot_name) is None:
+        raise HTTPException(status_code=404, detail=f"Unknown bot {bot_name}")
+    end = end or time.time()
+    start = start or end - TELEMETRY_WINDOW
+    return await telemetry.query(bot_name, METRICS[metric], start, end, resolution)
+
+
+@web_monitor.get("/db_stats")
+async def db_stats():
+    return {
+        "pool": database.pool_stats(),
+        "bot_id_cache": database.bot_id_cache_stats(),
+        "ingest": ingest_queue.stats.as_dict(),
+        "stats_cache": stats.cache.stats(),
+        "registry": bot_registry.stats(),
+        "telemetry": telemetry.stats(),
+        "retention": retention_job.stats(),
+    }
+
+
+@web_monitor.get("/stream_stats")
+async def stream_stats():
+    return {
+        "transcode_cache": fs.transcode_cache.stats(),
+        "stage_timings": {stage: h.snapshot() for stage, h in fs.stage_timings.items()},
+        "grid_clients": grid_channel.clients,
+        "frames_received": fs.frames_received,
+        "frames_unchanged": fs.frames_unchanged,
+    }
+
+
+@web_monitor.get("/metrics")
+async def metrics_endpoint():
+    return Response(metrics.registry.render(), media_type=metrics.PROMETHEUS_CONTENT_TYPE)
+
+
+@web_monitor.get("/metrics/subsystems")
+async def metrics_subsystems():
+    return metrics.registry.status()
+
+
+@web_monitor.put("/metrics/subsystems/{name}")
+async def set_metrics_subsystem(name: str, enabled: bool):
+    if name not in metrics.registry.status():
+        raise HTTPException(status_code=404, detail=f"Unknown metrics subsystem {name}")
+    metrics.registry.set_enabled(name, enabled)
+    return metrics.registry.status()
+
+
+@web_monitor.get("/stream_status")
+async def stream_status(stuck_after: float = STUCK_AFTER):
+    return fs.stream_status(stuck_after)
 
 
 @web_monitor.get("/video_feed/{stream_id}")
@@ -143,6 +390,28 @@ async def base64_stream():
     return StreamingResponse(fs.base64_mix_generator(await database.fetch_bots_name(), fps=5), media_type="multipart/x-mixed-replace;boundary=frame", status_code=206)
 
 
+@web_monitor.websocket("/ws/grid")
+async def grid_ws(websocket: WebSocket):
+    await grid_channel.serve(websocket)
+
+
+@web_monitor.get("/mosaic_feed")
+def mosaic_feed(columns: int = Query(DEFAULT_COLUMNS, gt=0), tile_width: int = Query(DEFAULT_TILE_WIDTH, gt=0),
+                fps: int = Query(5, gt=0)):
+    return fs.get_mosaic_stream(database.bot_ids.names, columns, tile_width, freq=fps)
+
+
+@web_monitor.get("/mosaic_layout")
+async def mosaic_layout(columns: int = Query(DEFAULT_COLUMNS, gt=0), tile_width: int = Query(DEFAULT_TILE_WIDTH, gt=0)):
+    # Se calcula de la lista de bots para que esté disponible antes de que corra un mosaic_feed
+    return layout_info(database.bot_ids.names(), *normalize_layout(columns, tile_width))
+
+
+@web_monitor.get("/grid_stream")
+async def grid_stream():
+    return StreamingResponse(fs.binary_mix_generator(await database.fetch_bots_name(), fps=5), media_type="application/octet-stream", status_code=206)
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -0,0 +1,51 @@
+"""
+    Micro-benchmark of the frame store backends: frames/sec for put and get with
+    several streams uploading JPEG frames.
+
+    Usage: python benchmarks/bench_frame_store.py [--streams 40] [--frames 2000] [--size 120000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frame_store import MemoryFrameStore, SharedMemoryFrameStore, SQLiteFrameStore  # noqa: E402
+
+
+def bench(name, store, streams, frames, payload):
+    ids = [f"bot{i}" for i in range(streams)]
+
+    start = time.perf_counter()
+    for i in range(frames):
+        store.put(ids[i % streams], payload)
+    put_rate = frames / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(frames):
+        store.get(ids[i % streams])
+    get_rate = frames / (time.perf_counter() - start)
+
+    print(f"{name:>7}: put {put_rate:>10,.0f} frames/s   get {get_rate:>10,.0f} frames/s")
+    store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", type=int, default=40)
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=120000, help="Frame size in bytes")
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size)
+    bench("memory", MemoryFrameStore(), args.streams, args.frames, payload)
+    bench("sqlite", SQLiteFrameStore("file:bench_frames?mode=memory&cache=shared"), args.streams, args.frames, payload)
+    with tempfile.TemporaryDirectory() as tmp:
+        bench("shm", SharedMemoryFrameStore(os.path.join(tmp, "frames"), slots=args.streams, slot_size=args.size),
+              args.streams, args.frames, payload)
+
+
+if __name__ == "__main__":
+    main()
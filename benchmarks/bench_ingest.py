@@ -0,0 +1,66 @@
+"""
+    Compara el rendimiento de escritura directa contra la cola de ingesta con una carga
+    sintética de bots enviando transacciones y temperaturas en paralelo.
+
+    Uso: python benchmarks/bench_ingest.py [--bots 100] [--events 50]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+from ingest import IngestQueue  # noqa: E402
+
+
+async def setup(path: str, bots: int):
+    await database.init(path)
+    for i in range(bots):
+        await database.insert_bot(f"bot{i}", "127.0.0.1", 0, "Unknown")
+
+
+async def bot_direct(name: str, events: int):
+    for i in range(events):
+        await database.insert_transaction(1000 + i, name)
+        await database.update_temp(name, 40 + i % 20)
+
+
+async def bot_queued(queue: IngestQueue, name: str, events: int):
+    for i in range(events):
+        await queue.add_transaction(name, 1000 + i)
+        await queue.update_temp(name, 40 + i % 20)
+
+
+async def run(mode: str, bots: int, events: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        await setup(os.path.join(tmp, "bench.db"), bots)
+        names = [f"bot{i}" for i in range(bots)]
+        start = time.perf_counter()
+        if mode == "direct":
+            await asyncio.gather(*(bot_direct(n, events) for n in names))
+        else:
+            queue = IngestQueue()
+            await queue.start()
+            await asyncio.gather(*(bot_queued(queue, n, events) for n in names))
+            await queue.stop()
+        elapsed = time.perf_counter() - start
+        await database.close()
+    writes = bots * events * 2
+    print(f"{mode:>7}: {writes} escrituras en {elapsed:.2f}s -> {writes / elapsed:,.0f} escrituras/s")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bots", type=int, default=100)
+    parser.add_argument("--events", type=int, default=50)
+    args = parser.parse_args()
+    await run("direct", args.bots, args.events)
+    await run("queued", args.bots, args.events)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,105 @@
+"""
+    Compara el cálculo de estadísticas de bot_details con pandas sobre las transacciones
+    (fetch_transactions_by_* + calculate_total_per_month) contra el módulo stats, que lee
+    las tablas de totales, sobre un historial sintético.
+
+    Uso: python benchmarks/bench_stats.py [--rows 5000000] [--bots 50] [--repeat 5]
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import database  # noqa: E402
+import stats  # noqa: E402
+
+
+def populate(path: str, rows: int, bots: int, today: datetime.date):
+    """
+        Llena la base con `rows` transacciones repartidas entre el 1 de enero y hoy.
+    """
+    start = datetime.datetime(today.year, 1, 1).timestamp()
+    span = datetime.datetime.combine(today, datetime.time(23, 59)).timestamp() - start
+    rng = random.Random(42)
+
+    def transactions():
+        for _ in range(rows):
+            date = datetime.datetime.fromtimestamp(start + rng.random() * span)
+            yield date.strftime("%Y-%m-%d %H:%M:%S"), rng.randint(1000, 500000), rng.randint(1, bots)
+
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO Bots (name, local_ip, temp, gathering_map) VALUES (?, '127.0.0.1', 0, 'Unknown')",
+                     [(f"bot{i}",) for i in range(1, bots + 1)])
+    conn.executemany("INSERT INTO Transactions (date, quantity, bot_id) VALUES (?, ?, ?)", transactions())
+    conn.commit()
+    conn.close()
+
+
+async def pandas_path(bot_name: str, today: datetime.date):
+    import data_tratment
+
+    transactions = await database.fetch_transactions_by_year(today.year, bot_name)
+    total_this_year, avg = data_tratment.calculate_total_per_month(transactions)
+    data_this_month = await database.fetch_transactions_by_month(today.year, today.month, bot_name, group_by_day=True)
+    return total_this_year, avg, data_this_month
+
+
+async def stats_path(bot_name: str, today: datetime.date):
+    return await stats.bot_stats(bot_name, today)
+
+
+async def measure(label: str, func, bot_name: str, today: datetime.date, repeat: int):
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func(bot_name, today)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(f"{label:>22}: mediana {timings[len(timings) // 2] * 1000:9.1f} ms   mínimo {timings[0] * 1000:9.1f} ms")
+
+
+def import_time(module: str) -> float:
+    code = f"import time; s = time.perf_counter(); import {module}; print(time.perf_counter() - s)"
+    return float(subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=ROOT).stdout)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000000)
+    parser.add_argument("--bots", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    today = datetime.date.today()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        await database.init(path)
+        await database.close()
+
+        start = time.perf_counter()
+        populate(path, args.rows, args.bots, today)
+        await database.init(path)
+        await database.rebuild_rollups()
+        print(f"{args.rows:,} transacciones generadas en {time.perf_counter() - start:.1f}s\n")
+
+        for bot_name, label in ((None, "granja"), ("bot1", "un bot")):
+            print(f"-- {label}")
+            await measure("pandas (transacciones)", pandas_path, bot_name, today, args.repeat)
+            await measure("stats (totales)", stats_path, bot_name, today, args.repeat)
+        await database.close()
+
+    print(f"\nimport pandas: {import_time('pandas') * 1000:.0f} ms   import stats: {import_time('stats') * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,304 @@
+"""
+    Synthetic bot-farm load test.
+
+    Simulates N bots (login, frames at a fixed fps, transactions and temperature heartbeats)
+    and M viewers per stream endpoint (/base64_stream and /video_feed), then reports
+    throughput and p50/p95/p99 latency per route, event-loop lag, frames delivered per viewer
+    and RSS. Results are saved as JSON so runs can be compared over time.
+
+    By default WebMonitor.web_monitor runs in-process on a uvicorn thread with a temporary
+    database; the client shares the process (and the GIL) with it, so for absolute numbers
+    run the server separately and pass --url (and --server-pid to report its RSS).
+
+    Needs the development requirements: pip install -r requirements-dev.txt (adds httpx).
+
+    Usage: python benchmarks/load_test.py [--bots 20] [--viewers 2] [--duration 30] [--fps 2]
+                                          [--url http://127.0.0.1:8082] [--server-pid PID] [--out FILE]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import cv2
+import httpx
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from metrics import LoopLagMonitor, Registry  # noqa: E402
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+LAG_INTERVAL = 0.05
+
+
+class Recorder:
+    """Latencies and errors per route."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def request(self, client: httpx.AsyncClient, route: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            if response.status_code >= 400:
+                self.errors[route] += 1
+        except httpx.HTTPError:
+            self.errors[route] += 1
+            return
+        self.latencies[route].append(time.perf_counter() - start)
+
+    def report(self, duration: float) -> dict:
+        routes = dict()
+        for route in sorted(set(self.latencies) | set(self.errors)):
+            timings = self.latencies[route]
+            routes[route] = {
+                "requests": len(timings),
+                "errors": self.errors[route],
+                "throughput": round(len(timings) / duration, 2),
+                "p50_ms": percentile_ms(timings, 0.50),
+                "p95_ms": percentile_ms(timings, 0.95),
+                "p99_ms": percentile_ms(timings, 0.99),
+            }
+        return routes
+
+
+def percentile_ms(values, q: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+
+def rss_mb(pid: int = None):
+    """Current RSS (MB) of pid, or peak RSS of this process when /proc is not available."""
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if pid is None:
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return None
+
+
+def make_frames(count: int, width: int, seed: int):
+    """Base64 JPEG frames with a moving block, so change detection does not drop them."""
+    height = width * 9 // 16
+    rng = np.random.default_rng(seed)
+    background = rng.integers(0, 255, (height // 8, width // 8, 3), dtype=np.uint8)
+    background = cv2.resize(background, (width, height), interpolation=cv2.INTER_LINEAR)
+    frames = list()
+    for i in range(count):
+        image = background.copy()
+        x = (i * width // count) % (width - width // 5)
+        cv2.rectangle(image, (x, height // 3), (x + width // 5, height // 3 + height // 4), (255, 255, 255), -1)
+        frames.append(base64.b64encode(cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 80])[1]).decode())
+    return frames
+
+
+async def every(interval: float, deadline: float, action):
+    # Random phase so the bots do not all fire at once
+    await asyncio.sleep(random.random() * interval)
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        await action()
+        await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+
+async def simulate_bot(client, recorder: Recorder, name: str, frames, args, deadline: float):
+    await recorder.request(client, "PUT /login_bot/{name}", "PUT", f"/login_bot/{name}",
+                           json={"ip": "127.0.0.1", "temp": 50, "gathering_map": "Bridgewatch"})
+    frame_index = 0
+
+    async def send_frame():
+        nonlocal frame_index
+        frame_index += 1
+        await recorder.request(client, "POST /send_frame_from_string/{name}", "POST",
+                               f"/send_frame_from_string/{name}",
+                               json={"img_base64str": frames[frame_index % len(frames)]})
+
+    async def add_transaction():
+        await recorder.request(client, "POST /add_transaction/{name}/{quantity}", "POST",
+                               f"/add_transaction/{name}/{random.randint(1000, 200000)}")
+
+    async def update_temp():
+        await recorder.request(client, "PUT /update_temp/{name}/{temp}", "PUT",
+                               f"/update_temp/{name}/{random.randint(45, 80)}")
+
+    await asyncio.gather(every(1.0 / args.fps, deadline, send_frame),
+                         every(args.transaction_interval, deadline, add_transaction),
+                         every(args.temp_interval, deadline, update_temp))
+
+
+async def watch(client, url: str, deadline: float, count_frames) -> dict:
+    """Read a stream until the deadline and count the frames in it."""
+    result = {"url": url, "frames": 0, "bytes": 0}
+
+    async def read():
+        tail = b""
+        async with client.stream("GET", url, timeout=None) as response:
+            async for chunk in response.aiter_bytes():
+                result["bytes"] += len(chunk)
+                found, tail = count_frames(tail + chunk)
+                result["frames"] += found
+
+    # Streams only send on new frames, so the read is cut at the deadline
+    try:
+        await asyncio.wait_for(read(), max(0.0, deadline - time.monotonic()))
+    except (asyncio.TimeoutError, httpx.HTTPError):
+        pass
+    return result
+
+
+def multipart_frames(data: bytes):
+    # Keep a tail shorter than the boundary in case it is split between chunks
+    return data.count(b"--frame\r\n"), data[-8:]
+
+
+def base64_frames(data: bytes):
+    # Every "name:base64" entry has exactly one ':' (bot names used here have none)
+    return data.count(b":"), b""
+
+
+async def run_load(base_url: str, args, lag: LoopLagMonitor) -> dict:
+    recorder = Recorder()
+    names = [f"loadbot{i}" for i in range(args.bots)]
+    frames = {name: make_frames(args.frame_variants, args.frame_width, i) for i, name in enumerate(names)}
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        lag_task = asyncio.create_task(lag.run()) if args.url else None
+        start = time.monotonic()
+        deadline = start + args.duration
+        bots = [asyncio.create_task(simulate_bot(client, recorder, name, frames[name], args, deadline))
+                for name in names]
+        # The viewers connect after the logins, so /base64_stream includes every bot
+        await asyncio.sleep(1.0)
+        viewers = [asyncio.create_task(watch(client, "/base64_stream", deadline, base64_frames))
+                   for _ in range(args.viewers)]
+        viewers += [asyncio.create_task(watch(client, f"/video_feed/{names[i % len(names)]}", deadline,
+                                              multipart_frames))
+                    for i in range(args.viewers)]
+        await asyncio.gather(*bots)
+        viewer_results = await asyncio.gather(*viewers)
+        elapsed = time.monotonic() - start
+        if lag_task is not None:
+            lag_task.cancel()
+
+        stats = dict()
+        for path in ("/db_stats", "/stream_stats"):
+            try:
+                stats[path] = (await client.get(path)).json()
+            except (httpx.HTTPError, ValueError):
+                pass
+
+    return {
+        "routes": recorder.report(elapsed),
+        "total_throughput": round(sum(len(v) for v in recorder.latencies.values()) / elapsed, 2),
+        "viewers": viewer_results,
+        "duration": round(elapsed, 2),
+        "server_stats": stats,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_in_process_server(port: int, lag: LoopLagMonitor):
+    """Run WebMonitor on a uvicorn thread; the lag monitor runs on the server's loop."""
+    import uvicorn
+
+    os.chdir(ROOT)
+    import WebMonitor
+
+    server = uvicorn.Server(uvicorn.Config(WebMonitor.web_monitor, host="127.0.0.1", port=port, log_level="warning"))
+
+    async def serve():
+        monitor = asyncio.create_task(lag.run())
+        try:
+            await server.serve()
+        finally:
+            monitor.cancel()
+
+    thread = threading.Thread(target=lambda: asyncio.run(serve()), daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bots", type=int, default=20)
+    parser.add_argument("--viewers", type=int, default=2, help="Viewers per stream endpoint")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--fps", type=float, default=2, help="Frames per second per bot")
+    parser.add_argument("--transaction-interval", type=float, default=10)
+    parser.add_argument("--temp-interval", type=float, default=5)
+    parser.add_argument("--frame-width", type=int, default=960)
+    parser.add_argument("--frame-variants", type=int, default=20)
+    parser.add_argument("--url", help="Test a running server instead of an in-process one")
+    parser.add_argument("--server-pid", type=int, help="PID of the --url server, to report its RSS")
+    parser.add_argument("--out", help="JSON output file (default: benchmarks/results/load_<time>.json)")
+    args = parser.parse_args()
+
+    # Own registry, so the samples do not mix with the server's /metrics
+    lag = LoopLagMonitor(Registry().subsystem("load_test"), interval=LAG_INTERVAL)
+    server = None
+    tmp = None
+    if args.url:
+        base_url = args.url
+    else:
+        tmp = tempfile.TemporaryDirectory()
+        os.environ["BOTS_DB_PATH"] = os.path.join(tmp.name, "load.db")
+        port = free_port()
+        server, thread = start_in_process_server(port, lag)
+        base_url = f"http://127.0.0.1:{port}"
+
+    results = asyncio.run(run_load(base_url, args, lag))
+    results["event_loop_lag"] = lag.report()
+    results["event_loop_lag"]["loop"] = "client" if args.url else "server"
+    results["rss_mb"] = rss_mb(args.server_pid) if args.url else rss_mb()
+    results["config"] = vars(args)
+    results["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    if server is not None:
+        server.should_exit = True
+        thread.join(timeout=10)
+        tmp.cleanup()
+
+    out = args.out or os.path.join(RESULTS_DIR, f"load_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{'route':<42}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for route, r in results["routes"].items():
+        print(f"{route:<42}{r['throughput']:>9}{r['p50_ms'] or '-':>9}{r['p95_ms'] or '-':>9}"
+              f"{r['p99_ms'] or '-':>9}{r['errors']:>8}")
+    for viewer in results["viewers"]:
+        print(f"viewer {viewer['url']:<36} {viewer['frames']:>6} frames  {viewer['bytes'] / 1e6:8.1f} MB")
+    print(f"loop lag ({results['event_loop_lag']['loop']}): {results['event_loop_lag']}")
+    print(f"RSS: {results['rss_mb']} MB")
+    print(f"Saved to {out}")
+
+
+if __name__ == "__main__":
+    main()
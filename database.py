@@ -1,262 +1,701 @@
 import datetime
+import os
 import sqlite3
-import os.path
-import json
-import pandas as pd
-import aiosqlite
+
+import metrics
+from db_pool import ConnectionPool
+
+
+# Se puede cambiar con la variable de entorno BOTS_DB_PATH (p. ej. para las pruebas de carga)
+DB_PATH = os.environ.get("BOTS_DB_PATH", "bots.db")
+READER_CONNECTIONS = 4
+# Filas por página al recorrer las transacciones para exportarlas
+EXPORT_PAGE_SIZE = 1000
+
+# Duración de cada función pública (ver metrics.py); se desactiva con METRICS_DISABLED=db
+DB_METRICS = metrics.registry.subsystem("db")
+timed = metrics.timed(DB_METRICS, DB_METRICS.histogram("db_function_duration_seconds",
+                                                       "Duration of each database.py function", ("function",)))
+
+
+# Recalcula desde cero las tablas de totales a partir de "Transactions".
+REBUILD_ROLLUPS_SQL = """
+    DELETE FROM DailyTotals;
+    DELETE FROM MonthlyTotals;
+    DELETE FROM FarmDailyTotals;
+    DELETE FROM FarmMonthlyTotals;
+    INSERT INTO DailyTotals (bot_id, day, quantity)
+        SELECT bot_id, substr(date, 1, 10), sum(quantity) FROM Transactions
+        WHERE bot_id IS NOT NULL GROUP BY 1, 2;
+    INSERT INTO MonthlyTotals (bot_id, month, quantity)
+        SELECT bot_id, substr(day, 1, 7), sum(quantity) FROM DailyTotals GROUP BY 1, 2;
+    INSERT INTO FarmDailyTotals (day, quantity)
+        SELECT substr(date, 1, 10), sum(quantity) FROM Transactions GROUP BY 1;
+    INSERT INTO FarmMonthlyTotals (month, quantity)
+        SELECT substr(day, 1, 7), sum(quantity) FROM FarmDailyTotals GROUP BY 1;
+"""
+
+# Suma a las tablas de totales las transacciones con id mayor que el indicado.
+# Se ejecutan en la misma transacción que el INSERT, justo después de él.
+APPLY_ROLLUPS_SQL = (
+    """INSERT INTO DailyTotals (bot_id, day, quantity)
+        SELECT bot_id, substr(date, 1, 10), sum(quantity) FROM Transactions
+        WHERE id > ? AND bot_id IS NOT NULL GROUP BY 1, 2
+        ON CONFLICT (bot_id, day) DO UPDATE SET quantity = quantity + excluded.quantity""",
+    """INSERT INTO MonthlyTotals (bot_id, month, quantity)
+        SELECT bot_id, substr(date, 1, 7), sum(quantity) FROM Transactions
+        WHERE id > ? AND bot_id IS NOT NULL GROUP BY 1, 2
+        ON CONFLICT (bot_id, month) DO UPDATE SET quantity = quantity + excluded.quantity""",
+    """INSERT INTO FarmDailyTotals (day, quantity)
+        SELECT substr(date, 1, 10), sum(quantity) FROM Transactions
+        WHERE id > ? GROUP BY 1
+        ON CONFLICT (day) DO UPDATE SET quantity = quantity + excluded.quantity""",
+    """INSERT INTO FarmMonthlyTotals (month, quantity)
+        SELECT substr(date, 1, 7), sum(quantity) FROM Transactions
+        WHERE id > ? GROUP BY 1
+        ON CONFLICT (month) DO UPDATE SET quantity = quantity + excluded.quantity""",
+)
+
+# Migraciones del esquema. Cada entrada es (versión, script) y se aplica una sola vez,
+# en orden, registrando la versión en PRAGMA user_version.
+MIGRATIONS = [
+    # 1: Esquema original
+    (1, """
+        CREATE TABLE IF NOT EXISTS Bots (
+            name TEXT,
+            local_ip TEXT,
+            temp INTEGER,
+            gathering_map TEXT
+        );
+        CREATE TABLE IF NOT EXISTS Transactions (
+            date TEXT,
+            quantity INTEGER,
+            bot_id INTEGER
+        );
+    """),
+    # 2: Claves primarias, nombres únicos y fechas normalizadas e indexadas.
+    # Los bots con nombre repetido se fusionan en el de menor rowid y sus transacciones
+    # pasan a apuntar a él. Las transacciones de bots borrados quedan con bot_id NULL.
+    (2, """
+        CREATE TEMP TABLE bot_remap AS
+            SELECT b.rowid AS old_id, (SELECT min(b2.rowid) FROM Bots b2 WHERE b2.name = b.name) AS new_id
+            FROM Bots b;
+
+        CREATE TABLE Bots_new (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            local_ip TEXT,
+            temp INTEGER,
+            gathering_map TEXT
+        );
+        INSERT INTO Bots_new (id, name, local_ip, temp, gathering_map)
+            SELECT rowid, name, local_ip, temp, gathering_map FROM Bots
+            WHERE rowid IN (SELECT new_id FROM bot_remap) AND name IS NOT NULL;
+
+        CREATE TABLE Transactions_new (
+            id INTEGER PRIMARY KEY,
+            date TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            bot_id INTEGER REFERENCES Bots(id) ON DELETE SET NULL
+        );
+        INSERT INTO Transactions_new (date, quantity, bot_id)
+            SELECT datetime(t.date), t.quantity, (SELECT new_id FROM bot_remap WHERE old_id = t.bot_id)
+            FROM Transactions t
+            WHERE datetime(t.date) IS NOT NULL
+            ORDER BY t.rowid;
+
+        DROP TABLE bot_remap;
+        DROP TABLE Transactions;
+        DROP TABLE Bots;
+        ALTER TABLE Bots_new RENAME TO Bots;
+        ALTER TABLE Transactions_new RENAME TO Transactions;
+
+        CREATE UNIQUE INDEX idx_bots_name ON Bots(name);
+        CREATE INDEX idx_transactions_bot_date ON Transactions(bot_id, date);
+        CREATE INDEX idx_transactions_date ON Transactions(date);
+    """),
+    # 3: Tablas de totales pre-agregados por día y por mes, por bot y de toda la granja
+    (3, """
+        CREATE TABLE DailyTotals (
+            bot_id INTEGER NOT NULL REFERENCES Bots(id) ON DELETE CASCADE,
+            day TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            PRIMARY KEY (bot_id, day)
+        ) WITHOUT ROWID;
+        CREATE TABLE MonthlyTotals (
+            bot_id INTEGER NOT NULL REFERENCES Bots(id) ON DELETE CASCADE,
+            month TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            PRIMARY KEY (bot_id, month)
+        ) WITHOUT ROWID;
+        CREATE TABLE FarmDailyTotals (
+            day TEXT PRIMARY KEY,
+            quantity INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE FarmMonthlyTotals (
+            month TEXT PRIMARY KEY,
+            quantity INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """ + REBUILD_ROLLUPS_SQL),
+    # 4: Clave de idempotencia opcional de cada transacción, para descartar reenvíos
+    (4, """
+        ALTER TABLE Transactions ADD COLUMN idempotency_key TEXT;
+        CREATE UNIQUE INDEX idx_transactions_idempotency_key ON Transactions(idempotency_key)
+            WHERE idempotency_key IS NOT NULL;
+    """),
+    # 5: Series de tiempo de telemetría (ver timeseries.py): muestras crudas y promedios por minuto y por hora
+    (5, """
+        CREATE TABLE TelemetryRaw (
+            bot_id INTEGER NOT NULL REFERENCES Bots(id) ON DELETE CASCADE,
+            metric INTEGER NOT NULL,
+            ts REAL NOT NULL,
+            value REAL NOT NULL
+        );
+        CREATE INDEX idx_telemetry_raw ON TelemetryRaw(bot_id, metric, ts);
+        CREATE INDEX idx_telemetry_raw_ts ON TelemetryRaw(ts);
+        CREATE TABLE Telemetry1m (
+            bot_id INTEGER NOT NULL REFERENCES Bots(id) ON DELETE CASCADE,
+            metric INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            sum REAL NOT NULL,
+            min REAL NOT NULL,
+            max REAL NOT NULL,
+            PRIMARY KEY (bot_id, metric, ts)
+        ) WITHOUT ROWID;
+        CREATE INDEX idx_telemetry_1m_ts ON Telemetry1m(ts);
+        CREATE TABLE Telemetry1h (
+            bot_id INTEGER NOT NULL REFERENCES Bots(id) ON DELETE CASCADE,
+            metric INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            sum REAL NOT NULL,
+            min REAL NOT NULL,
+            max REAL NOT NULL,
+            PRIMARY KEY (bot_id, metric, ts)
+        ) WITHOUT ROWID;
+        CREATE INDEX idx_telemetry_1h_ts ON Telemetry1h(ts);
+    """),
+    # 6: Retención (ver retention.py). compacted = 1 marca las filas que resumen un día de un bot
+    # cuyas transacciones se movieron al archivo del mes; size es lo confirmado de ese archivo.
+    (6, """
+        ALTER TABLE Transactions ADD COLUMN compacted INTEGER NOT NULL DEFAULT 0;
+        CREATE TABLE TransactionArchives (
+            month TEXT PRIMARY KEY,
+            rows INTEGER NOT NULL,
+            size INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """),
+]
+
+
+async def migrate(conn):
+    """
+        Actualiza el esquema de la base de datos a la última versión de MIGRATIONS.
+
+        Cada migración se ejecuta en su propia transacción, así que una base de datos
+        existente se actualiza en el sitio y nunca queda a medio migrar.
+    """
+    c = await conn.execute("PRAGMA user_version")
+    (version,) = await c.fetchone()
+    pending = [(target, script) for target, script in MIGRATIONS if target > version]
+    if not pending:
+        return
+
+    c = await conn.execute("SELECT count(*) FROM sqlite_master")
+    (objects,) = await c.fetchone()
+    if not objects:
+        # Base nueva: el VACUUM es instantáneo y deja activo el auto_vacuum incremental que usa
+        # retention.py para devolver el espacio liberado sin reescribir todo el archivo
+        await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await conn.execute("VACUUM")
+
+    # Las tablas se reconstruyen, así que las claves foráneas se desactivan mientras tanto
+    await conn.execute("PRAGMA foreign_keys = OFF")
+    try:
+        for target, script in pending:
+            try:
+                await conn.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {target};\nCOMMIT;")
+            except sqlite3.Error:
+                await conn.rollback()
+                raise
+    finally:
+        await conn.execute("PRAGMA foreign_keys = ON")
+
+
+def _year_range(year: int):
+    """
+        Devuelve el intervalo semiabierto [inicio, fin) de un año para comparar con Transactions.date.
+    """
+    return f"{year:04}-01-01", f"{year + 1:04}-01-01"
+
+
+def _month_range(year: int, month: int):
+    """
+        Devuelve el intervalo semiabierto [inicio, fin) de un mes para comparar con Transactions.date.
+    """
+    if month == 12:
+        return f"{year:04}-12-01", f"{year + 1:04}-01-01"
+    return f"{year:04}-{month:02}-01", f"{year:04}-{month + 1:02}-01"
 
 
-async def connect():
+class BotIdCache:
     """
-        Establece una conexión con la base de datos o crea una nueva si no existe.
+        Caché en memoria nombre -> id de la tabla "Bots".
+
+        Se carga completa al abrir la base de datos y se mantiene al día desde insert_bot,
+        delete_bot y update_bot, así que resolver el id de un bot no toca SQLite.
+        version cambia cada vez que se agrega o se quita un bot.
+    """
+
+    def __init__(self):
+        self._ids = dict()
+        self.hits = 0
+        self.misses = 0
+        self.version = 0
+
+    def get(self, name: str):
+        bot_id = self._ids.get(name)
+        if bot_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return bot_id
+
+    def set(self, name: str, bot_id: int):
+        if name not in self._ids:
+            self.version += 1
+        self._ids[name] = bot_id
+
+    def discard(self, name: str):
+        if self._ids.pop(name, None) is not None:
+            self.version += 1
+
+    def load(self, rows):
+        self._ids = {name: bot_id for bot_id, name in rows}
+        self.version += 1
+
+    def names(self):
+        return sorted(self._ids)
+
+    def stats(self):
+        return {"size": len(self._ids), "hits": self.hits, "misses": self.misses}
+
+
+pool = ConnectionPool(DB_PATH, readers=READER_CONNECTIONS, on_open=migrate)
+bot_ids = BotIdCache()
+# Id de la última transacción y número de veces que los totales cambiaron sin insertar
+# transacciones (borrado de un bot, reconstrucción). Juntos forman data_version().
+last_transaction_id = 0
+rollups_version = 0
+
+# Funciones llamadas con los nombres de los bots cuyas transacciones cambiaron (None = todos)
+_transaction_listeners = list()
+
+
+def add_transaction_listener(listener):
     """
-    if os.path.isfile("./bots.db"):
-        conn = await aiosqlite.connect("bots.db")
+        Registra una función que se llama, después del commit, con el conjunto de bots a los que
+        se les insertaron transacciones, o con None si cambiaron los totales de todos los bots.
+    """
+    _transaction_listeners.append(listener)
+
+
+def data_version() -> str:
+    """
+        Cadena que cambia cada vez que cambian las transacciones o los totales. Sirve de ETag.
+    """
+    return f"{last_transaction_id}.{rollups_version}"
+
+
+def _notify_transactions(bot_names, last_id: int = None):
+    global last_transaction_id, rollups_version
+    if last_id is None:
+        rollups_version += 1
     else:
-        conn = await create_tables()
+        last_transaction_id = max(last_transaction_id, last_id)
+    for listener in _transaction_listeners:
+        try:
+            listener(bot_names)
+        except Exception as e:
+            print(f"Error en un listener de transacciones: {e}")
 
-    #  conn.execute('PRAGMA journal_mode = OFF;')  # Prevents to insert a row
-    #  conn.execute('PRAGMA synchronous = 0;')
-    #  conn.execute('PRAGMA cache_size = 1000000;')  # give it a GB
-    #  conn.execute('PRAGMA locking_mode = EXCLUSIVE;')
-    #  conn.execute('PRAGMA temp_store = MEMORY;')
 
-    return conn
+async def init(path: str = DB_PATH):
+    """
+        Abre el pool de conexiones. Se llama desde el lifespan de la aplicación.
+    """
+    global pool
+    if pool.path != path:
+        await pool.close()
+        pool = ConnectionPool(path, readers=READER_CONNECTIONS, on_open=migrate)
+    await pool.open()
+    await warm_bot_id_cache()
+    global last_transaction_id
+    async with pool.reader() as conn:
+        last_transaction_id = await _last_transaction_id(conn)
+
+
+async def warm_bot_id_cache():
+    """
+        Carga en la caché los ids de todos los bots.
+    """
+    async with pool.reader() as conn:
+        c = await conn.execute("""SELECT id, name FROM Bots""")
+        bot_ids.load(await c.fetchall())
 
 
-async def create_tables():
+async def close():
     """
-        Crea las tablas "Bots" y "Transactions" en la base de datos.
+        Cierra el pool de conexiones.
     """
-    conn = await aiosqlite.connect("bots.db")
+    await pool.close()
 
-    await conn.execute("""CREATE TABLE IF NOT EXISTS Bots (
-        name TEXT,
-        local_ip TEXT,
-        temp INTEGER,
-        gathering_map TEXT
-    )""")
 
-    await conn.execute("""CREATE TABLE IF NOT EXISTS Transactions (
-            date TEXT,
-            quantity INTEGER,
-            bot_id INTEGER
-    )""")
+def pool_stats():
+    """
+        Devuelve las métricas de uso del pool de conexiones.
+    """
+    return pool.stats.as_dict()
+
 
-    await conn.commit()
-    return conn
+def bot_id_cache_stats():
+    """
+        Devuelve los aciertos y fallos de la caché de ids de bots.
+    """
+    return bot_ids.stats()
 
 
+@timed
 async def fetch_all_bots(in_json=True):
     """
         Devuelve todos las entradas de la tabla "Bots".
     """
-    conn = await connect()
-    if in_json:
-        conn.row_factory = sqlite3.Row
-    c = await conn.execute("""SELECT * FROM Bots""")
-    rows = await c.fetchall()
-    await conn.close()
+    async with pool.reader(sqlite3.Row if in_json else None) as conn:
+        c = await conn.execute("""SELECT * FROM Bots""")
+        rows = await c.fetchall()
 
     if in_json:
-        rows = json.dumps([dict(ix) for ix in rows])
-        rows = json.loads(rows)
+        rows = [dict(ix) for ix in rows]
 
     return rows
 
 
+@timed
 async def fetch_bots_name():
-    conn = await connect()
-    conn.row_factory = sqlite3.Row
-    c = await conn.execute("""SELECT name FROM Bots""")
-    rows = await c.fetchall()
-    await conn.close()
+    async with pool.reader(sqlite3.Row) as conn:
+        c = await conn.execute("""SELECT name FROM Bots""")
+        rows = await c.fetchall()
 
-    rows = json.dumps([dict(ix) for ix in rows])
-    rows = json.loads(rows)
-
-    return rows
+    return [dict(ix) for ix in rows]
 
 
+@timed
 async def fetch_bot_details(bot_name: str, in_json=True):
-    conn = await connect()
-    if in_json:
-        conn.row_factory = sqlite3.Row
-    c = await conn.execute("""SELECT * FROM Bots WHERE name = (?)""", [bot_name])
-    rows = await c.fetchall()
-    await conn.close()
+    async with pool.reader(sqlite3.Row if in_json else None) as conn:
+        c = await conn.execute("""SELECT * FROM Bots WHERE name = (?)""", [bot_name])
+        rows = await c.fetchall()
 
     if in_json:
-        rows = json.dumps([dict(ix) for ix in rows])
-        rows = json.loads(rows)
+        rows = [dict(ix) for ix in rows]
     return rows[0]
 
 
+@timed
 async def insert_bot(name: str, local_ip: str, temp: int, gathering_map: str):
     """
         Inserta un nuevo bot en la tabla "Bots".
     """
-    conn = await connect()
-
-    await conn.execute("""INSERT INTO Bots VALUES (?,?,?,?)""", (name, local_ip, temp, gathering_map))
-    await conn.commit()
-    await conn.close()
+    async with pool.writer() as conn:
+        c = await conn.execute("""INSERT INTO Bots (name, local_ip, temp, gathering_map) VALUES (?,?,?,?)
+                        ON CONFLICT(name) DO UPDATE SET local_ip = excluded.local_ip
+                        RETURNING id""", (name, local_ip, temp, gathering_map))
+        (bot_id,) = await c.fetchone()
+    bot_ids.set(name, bot_id)
 
 
+@timed
 async def delete_bot(name: str):
     """
         Borra un bot de la tabla "Bots".
     """
-    conn = await connect()
-    await conn.execute("""DELETE FROM Bots WHERE name = (?)""", [name])
-    await conn.commit()
-    await conn.close()
+    async with pool.writer() as conn:
+        await conn.execute("""DELETE FROM Bots WHERE name = (?)""", [name])
+    bot_ids.discard(name)
+    # Sus totales se borran en cascada
+    _notify_transactions({name})
 
 
+@timed
 async def update_bot(name: str, local_ip: str, temp: int, gathering_map: str):
-    conn = await connect()
-
-    await conn.execute("""UPDATE Bots SET local_ip = (?), temp = (?), gathering_map = (?)
-                    WHERE name = (?)""", (local_ip, temp, gathering_map, name))
-    await conn.commit()
-    await conn.close()
+    async with pool.writer() as conn:
+        c = await conn.execute("""UPDATE Bots SET local_ip = (?), temp = (?), gathering_map = (?)
+                        WHERE name = (?)""", (local_ip, temp, gathering_map, name))
+        updated = c.rowcount
+    if not updated:
+        bot_ids.discard(name)
 
 
+@timed
 async def update_temp(bot_name: str, new_temp: int):
     """
         Actualiza la temperatura de un bot en la tabla "Bots".
     """
-    conn = await connect()
-
-    await conn.execute("""UPDATE Bots SET temp = (?)
-                WHERE name = (?)""", (new_temp, bot_name))
-    await conn.commit()
-    await conn.close()
+    async with pool.writer() as conn:
+        await conn.execute("""UPDATE Bots SET temp = (?)
+                    WHERE name = (?)""", (new_temp, bot_name))
 
 
+@timed
 async def update_local_ip(bot_name: str, new_ip: str):
     """
         Actualiza la dirección IP local de un bot en la tabla "Bots".
     """
-    conn = await connect()
-
-    conn.execute("""UPDATE Bots SET local_ip = (?)
-                    WHERE name = (?)""", (new_ip, bot_name))
-    await conn.commit()
-    await conn.close()
+    async with pool.writer() as conn:
+        await conn.execute("""UPDATE Bots SET local_ip = (?)
+                        WHERE name = (?)""", (new_ip, bot_name))
 
 
+@timed
 async def insert_transaction(quantity: int, bot_name: str, date=None):
     """
         Inserta una nueva transacción en la tabla "Transactions" asociada a un bot.
     """
-    conn = await connect()
     if date is None:
         date = datetime.datetime.now()
     bot_id = await get_bot_id(bot_name)
-    await conn.execute("""INSERT INTO Transactions VALUES (datetime(?),?,?)""", (date, quantity, bot_id))
-    await conn.commit()
-    await conn.close()
+    async with pool.writer() as conn:
+        c = await conn.execute("""INSERT INTO Transactions (date, quantity, bot_id) VALUES (datetime(?),?,?)""",
+                               (date, quantity, bot_id))
+        await _apply_rollups(conn, c.lastrowid - 1)
+    _notify_transactions({bot_name}, c.lastrowid)
 
 
-async def insert_batch_transactions(transactions_list):
+@timed
+async def insert_batch_transactions(transactions_list, temp_updates=None):
     """
-        Inserta una lista de transacciones en la tabla "Transactions" asociada a un bot.
+        Inserta una lista de transacciones en la tabla "Transactions" en una sola transacción.
 
         El formato esperado es:
-        transaction_list = [(bot_name, quantity)]
+        transaction_list = [(bot_name, quantity)], [(bot_name, quantity, date)] o
+                           [(bot_name, quantity, date, idempotency_key)]
+
+        Si no se indica la fecha se usa la hora actual. Las transacciones cuya idempotency_key ya
+        está guardada (o se repite dentro de la misma lista) se descartan, así que un cliente puede
+        reenviar un lote sin duplicar nada. temp_updates es un diccionario opcional
+        {bot_name: temp} con las temperaturas a actualizar en el mismo commit.
 
         Esta funcíon se usa cuando una serie de transacciones no han sido ingresadas en la base de datos
         y el cliente manda una lista de las transacciones que no ha podido guardar ya sea por que el servidor
-        no esta disponible o hay algun problema con la red.
+        no esta disponible o hay algun problema con la red. También es la primitiva de escritura de la
+        cola de ingesta (ver ingest.py).
+
+        Devuelve (insertadas, duplicadas).
     """
-    conn = await connect()
-    bot_name = transactions_list[0][0]
-    bot_id = await get_bot_id(bot_name)
-    date = datetime.datetime.now()
+    now = datetime.datetime.now()
+    resolved_ids = dict()
     t_ready = list()
     for transaction in transactions_list:
-        t_ready.append((date, transaction[1], bot_id))
+        bot_name, quantity = transaction[0], transaction[1]
+        date = transaction[2] if len(transaction) > 2 and transaction[2] is not None else now
+        key = transaction[3] if len(transaction) > 3 else None
+        if bot_name not in resolved_ids:
+            resolved_ids[bot_name] = await get_bot_id(bot_name)
+        t_ready.append((date, quantity, resolved_ids[bot_name], key, bot_name))
+
+    async with pool.writer() as conn:
+        # El filtro se hace con el lock de escritura tomado: nadie más puede insertar la misma clave
+        seen = await _existing_idempotency_keys(conn, [t[3] for t in t_ready if t[3] is not None])
+        rows = list()
+        for date, quantity, bot_id, key, bot_name in t_ready:
+            if key is not None:
+                if key in seen:
+                    continue
+                seen.add(key)
+            rows.append((date, quantity, bot_id, key, bot_name))
+
+        if rows:
+            last_id = await _last_transaction_id(conn)
+            await conn.executemany("""INSERT INTO Transactions (date, quantity, bot_id, idempotency_key)
+                                   VALUES (datetime(?),?,?,?)""", [row[:4] for row in rows])
+            await _apply_rollups(conn, last_id)
+            last_id = await _last_transaction_id(conn)
+        if temp_updates:
+            await conn.executemany("""UPDATE Bots SET temp = (?) WHERE name = (?)""",
+                                   [(temp, name) for name, temp in temp_updates.items()])
+    if rows:
+        _notify_transactions({row[4] for row in rows}, last_id)
+    return len(rows), len(t_ready) - len(rows)
+
+
+async def _existing_idempotency_keys(conn, keys):
+    """
+        Devuelve el subconjunto de keys que ya está en "Transactions".
+    """
+    existing = set()
+    keys = list(set(keys))
+    # Por debajo del límite de parámetros de SQLite
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        c = await conn.execute(f"""SELECT idempotency_key FROM Transactions
+                                   WHERE idempotency_key IN ({",".join("?" * len(chunk))})""", chunk)
+        existing.update(key for (key,) in await c.fetchall())
+    return existing
+
+
+async def _last_transaction_id(conn):
+    c = await conn.execute("""SELECT coalesce(max(id), 0) FROM Transactions""")
+    (last_id,) = await c.fetchone()
+    return last_id
+
+
+async def _apply_rollups(conn, after_id: int):
+    """
+        Actualiza las tablas de totales con las transacciones insertadas después de after_id.
+
+        Debe llamarse con la conexión de escritura dentro de la misma transacción del INSERT.
+    """
+    for query in APPLY_ROLLUPS_SQL:
+        await conn.execute(query, (after_id, ))
+
+
+@timed
+async def rebuild_rollups():
+    """
+        Recalcula las tablas de totales diarios y mensuales a partir de todas las transacciones.
+    """
+    async with pool.writer() as conn:
+        for statement in REBUILD_ROLLUPS_SQL.split(";"):
+            if statement.strip():
+                await conn.execute(statement)
+    _notify_transactions(None)
+
+
+@timed
+async def fetch_monthly_totals(year: int, bot_name: str = None):
+    """
+        Devuelve [(mes 'YYYY-MM', total)] de un año desde las tablas de totales.
+
+        Si bot_name es None se devuelven los totales de toda la granja.
+    """
+    start, end = _year_range(year)
+    if bot_name:
+        query = """SELECT month, quantity FROM MonthlyTotals
+                   WHERE bot_id = ? AND month >= ? AND month < ? ORDER BY month"""
+        params = (await get_bot_id(bot_name), start[:7], end[:7])
+    else:
+        query = """SELECT month, quantity FROM FarmMonthlyTotals
+                   WHERE month >= ? AND month < ? ORDER BY month"""
+        params = (start[:7], end[:7])
+
+    async with pool.reader() as conn:
+        c = await conn.execute(query, params)
+        return await c.fetchall()
+
+
+@timed
+async def fetch_daily_totals(year: int, month: int, bot_name: str = None):
+    """
+        Devuelve [(día 'YYYY-MM-DD', total)] de un mes desde las tablas de totales.
+
+        Si bot_name es None se devuelven los totales de toda la granja.
+    """
+    start, end = _month_range(year, month)
+    if bot_name:
+        query = """SELECT day, quantity FROM DailyTotals
+                   WHERE bot_id = ? AND day >= ? AND day < ? ORDER BY day"""
+        params = (await get_bot_id(bot_name), start, end)
+    else:
+        query = """SELECT day, quantity FROM FarmDailyTotals
+                   WHERE day >= ? AND day < ? ORDER BY day"""
+        params = (start, end)
 
-    await conn.execute("BEGIN")
-    await conn.executemany("INSERT INTO Transactions VALUES (datetime(?),?,?)", t_ready)
-    await conn.commit()
-    await conn.close()
+    async with pool.reader() as conn:
+        c = await conn.execute(query, params)
+        return await c.fetchall()
 
 
+@timed
 async def fetch_all_transactions_from_bot(bot_name: str, in_json=True):
     """
         Obtiene todas las transacciones asociadas a un bot de la tabla "Transactions".
     """
-    conn = await connect()
-    if in_json:
-        conn.row_factory = sqlite3.Row
-    bot_id = get_bot_id(bot_name)
-    if bot_id:
+    bot_id = await get_bot_id(bot_name)
+    if not bot_id:
+        return list()
+
+    async with pool.reader(sqlite3.Row if in_json else None) as conn:
         c = await conn.execute("""SELECT * FROM Transactions WHERE bot_id = (?)""", [bot_id])
         rows = await c.fetchall()
-        if in_json:
-            rows = json.dumps([dict(ix) for ix in rows])
-            rows = json.loads(rows)
-    else:
-        rows = list()
-    await conn.close()
+
+    if in_json:
+        rows = [dict(ix) for ix in rows]
     return rows
 
 
+@timed
 async def fetch_transactions_by_year(year: int, bot_name: str = None):
     """
     Obtiene las transacciones de un año específico y un bot_id dado directamente de la base de datos.
+
+    El filtro es un rango semiabierto sobre la fecha, de modo que la consulta usa los índices
+    idx_transactions_bot_date / idx_transactions_date.
     """
-    conn = await connect()
+    start, end = _year_range(year)
     if bot_name:
         bot_id = await get_bot_id(bot_name)
         query = """
             SELECT date, quantity
             FROM Transactions
-            WHERE strftime('%Y', date) = ? AND bot_id = ?
+            WHERE bot_id = ? AND date >= ? AND date < ?
         """
-        async with conn.execute(query, (str(year), str(bot_id))) as cursor:
-            rows = await cursor.fetchall()
-            # Crear un DataFrame de pandas a partir de los resultados
-            df = pd.DataFrame(rows, columns=['date', 'quantity'])
+        params = (bot_id, start, end)
     else:
         query = """
             SELECT date, quantity
             FROM Transactions
-            WHERE strftime('%Y', date) = ?
+            WHERE date >= ? AND date < ?
         """
-        async with conn.execute(query, (str(year), )) as cursor:
+        params = (start, end)
+
+    async with pool.reader() as conn:
+        async with conn.execute(query, params) as cursor:
             rows = await cursor.fetchall()
-            # Crear un DataFrame de pandas a partir de los resultados
-            df = pd.DataFrame(rows, columns=['date', 'quantity'])
-    return df
 
+    # pandas solo se importa aquí: es lento de cargar y el resto del módulo no lo necesita
+    import pandas as pd
 
+    # Crear un DataFrame de pandas a partir de los resultados
+    return pd.DataFrame(rows, columns=['date', 'quantity'])
+
+
+@timed
 async def fetch_transactions_by_month(year: int, month: int, bot_name: str = None, group_by_day=False):
-    month = f"{month:02}"
-    conn = await connect()
+    start, end = _month_range(year, month)
     if bot_name:
         bot_id = await get_bot_id(bot_name)
         query = """
                 SELECT date, quantity
                 FROM Transactions
-                WHERE strftime('%Y', date) = ? AND strftime('%m', date) = ? AND bot_id = ?
+                WHERE bot_id = ? AND date >= ? AND date < ?
             """
-        async with conn.execute(query, (str(year), str(month), str(bot_id))) as cursor:
-            rows = await cursor.fetchall()
-            # Creamos un DataFrame de pandas a partir de los resultados
-            transactions = pd.DataFrame(rows, columns=['date', 'quantity'])
+        params = (bot_id, start, end)
     else:
         query = """
             SELECT date, quantity
             FROM Transactions
-            WHERE strftime('%Y', date) = ? AND strftime('%m', date) = ?
+            WHERE date >= ? AND date < ?
         """
-        async with conn.execute(query, (str(year), str(month))) as cursor:
+        params = (start, end)
+
+    async with pool.reader() as conn:
+        async with conn.execute(query, params) as cursor:
             rows = await cursor.fetchall()
-            # Creamos un DataFrame de pandas a partir de los resultados
-            transactions = pd.DataFrame(rows, columns=['date', 'quantity'])
+
+    import pandas as pd
+
+    # Creamos un DataFrame de pandas a partir de los resultados
+    transactions = pd.DataFrame(rows, columns=['date', 'quantity'])
 
     if not group_by_day:
         return transactions
@@ -269,29 +708,83 @@ async def fetch_transactions_by_month(year: int, month: int, bot_name: str = Non
         return daily_transactions
 
 
-async def get_bot_id(bot_name: str):
+async def iter_transactions(bot_id: int = None, start: str = None, end: str = None, min_quantity: int = None,
+                            page_size: int = EXPORT_PAGE_SIZE):
     """
-        Obtiene el ID de un bot según su nombre en la tabla "Bots".
-    """
-    conn = await connect()
-    c = await conn.execute("""SELECT rowid FROM Bots WHERE name = (?)""", [bot_name])
-    try:
-        result = await c.fetchone()
-        if result is None:
-            bot_id = None
-        else:
-            bot_id = result[0]
-    except TypeError:
-        bot_id = None
-    await conn.close()
-    return bot_id
+        Recorre las transacciones ordenadas por fecha, de a page_size filas: [(id, fecha, bot, cantidad, compacted)].
 
+        Filtros opcionales: bot_id, fecha en [start, end) y cantidad mínima. Cada página es una
+        consulta por clave (fecha, id) mayor que la última fila entregada, sobre los índices
+        idx_transactions_date / idx_transactions_bot_date, así que cuesta lo mismo la primera que
+        la última. La conexión de lectura se devuelve al pool entre páginas: un cliente lento no
+        la retiene y la memoria no depende del total de filas.
 
-async def create_date_transactions_index():
+        Las transacciones que ya se archivaron (ver retention.py) aparecen como totales por día.
     """
-    Crea un índice en la columna 'date' de la tabla 'Transactions'.
+    conditions = ["(t.date, t.id) > (?, ?)"]
+    filters = list()
+    if bot_id is not None:
+        conditions.append("t.bot_id = ?")
+        filters.append(bot_id)
+    if end is not None:
+        conditions.append("t.date < ?")
+        filters.append(end)
+    if min_quantity is not None:
+        conditions.append("t.quantity >= ?")
+        filters.append(min_quantity)
+    query = f"""SELECT t.id, t.date, b.name, t.quantity, t.compacted
+                FROM Transactions t LEFT JOIN Bots b ON b.id = t.bot_id
+                WHERE {" AND ".join(conditions)}
+                ORDER BY t.date, t.id LIMIT ?"""
+
+    last_date, last_id = start or "", 0
+    while True:
+        async with pool.reader() as conn:
+            c = await conn.execute(query, (last_date, last_id, *filters, page_size))
+            rows = await c.fetchall()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        last_id, last_date = rows[-1][0], rows[-1][1]
+
+
+@timed
+async def get_bot_id(bot_name: str):
     """
-    conn = await connect()
-    await conn.execute("CREATE INDEX idx_transactions_date ON Transactions(date)")
-    await conn.commit()
-    await conn.close()
+        Obtiene el ID de un bot según su nombre en la tabla "Bots".
+
+        Primero se consulta la caché; solo si el nombre no está se va a la base de datos.
+    """
+    bot_id = bot_ids.get(bot_name)
+    if bot_id is not None:
+        return bot_id
+
+    async with pool.reader() as conn:
+        c = await conn.execute("""SELECT id FROM Bots WHERE name = (?)""", [bot_name])
+        result = await c.fetchone()
+    if result is None:
+        return None
+    bot_ids.set(bot_name, result[0])
+    return result[0]
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+
+    parser = argparse.ArgumentParser(description="Tareas de mantenimiento de la base de datos.")
+    parser.add_argument("command", choices=["rebuild-rollups"])
+    parser.add_argument("--db", default=DB_PATH)
+    args = parser.parse_args()
+
+    async def main():
+        await init(args.db)
+        try:
+            if args.command == "rebuild-rollups":
+                await rebuild_rollups()
+        finally:
+            await close()
+
+    asyncio.run(main())
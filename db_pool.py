@@ -0,0 +1,151 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+# PRAGMAs aplicados a cada conexión del pool.
+# WAL permite que los lectores trabajen mientras el escritor hace commit y
+# synchronous = NORMAL solo hace fsync en los checkpoints del WAL.
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA cache_size = -64000;",  # 64 MB por conexión
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA busy_timeout = 5000;",
+    "PRAGMA foreign_keys = ON;",
+)
+
+
+class PoolStats:
+    """Contadores de uso del pool de conexiones."""
+
+    def __init__(self):
+        self.hits = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.writer_hits = 0
+        self.writer_waits = 0
+        self.writer_wait_time = 0.0
+
+    def as_dict(self):
+        return {
+            "hits": self.hits,
+            "waits": self.waits,
+            "wait_time": round(self.wait_time, 6),
+            "writer_hits": self.writer_hits,
+            "writer_waits": self.writer_waits,
+            "writer_wait_time": round(self.writer_wait_time, 6),
+        }
+
+
+class ConnectionPool:
+    """
+        Pool de conexiones aiosqlite de larga duración.
+
+        Mantiene un número fijo de conexiones de lectura y una única conexión de escritura,
+        de modo que cada petición reutiliza una conexión abierta en vez de crear un hilo nuevo.
+    """
+
+    def __init__(self, path: str, readers: int = 4, on_open=None):
+        self.path = path
+        self.size = readers
+        self.stats = PoolStats()
+        self._on_open = on_open
+        self._readers = asyncio.Queue()
+        self._all_readers = list()
+        self._writer = None
+        self._writer_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self._opened = False
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path)
+        for pragma in CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+
+    async def open(self):
+        """
+            Abre la conexión de escritura y las de lectura. Es seguro llamarla varias veces.
+        """
+        async with self._open_lock:
+            if self._opened:
+                return
+            self._writer = await self._connect()
+            if self._on_open is not None:
+                await self._on_open(self._writer)
+            for _ in range(self.size):
+                conn = await self._connect()
+                self._all_readers.append(conn)
+                self._readers.put_nowait(conn)
+            self._opened = True
+
+    async def close(self):
+        """
+            Cierra todas las conexiones del pool.
+        """
+        async with self._open_lock:
+            if not self._opened:
+                return
+            async with self._writer_lock:
+                await self._writer.close()
+                self._writer = None
+            for conn in self._all_readers:
+                await conn.close()
+            self._all_readers.clear()
+            self._readers = asyncio.Queue()
+            self._opened = False
+
+    @property
+    def is_open(self):
+        return self._opened
+
+    @asynccontextmanager
+    async def reader(self, row_factory=None):
+        """
+            Presta una conexión de lectura. Si no hay ninguna libre espera a que se devuelva una.
+        """
+        if not self._opened:
+            await self.open()
+        try:
+            conn = self._readers.get_nowait()
+            self.stats.hits += 1
+        except asyncio.QueueEmpty:
+            start = time.perf_counter()
+            conn = await self._readers.get()
+            self.stats.waits += 1
+            self.stats.wait_time += time.perf_counter() - start
+        conn.row_factory = row_factory
+        try:
+            yield conn
+        finally:
+            conn.row_factory = None
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self, row_factory=None):
+        """
+            Presta la única conexión de escritura. Hace commit al salir o rollback si hubo un error.
+        """
+        if not self._opened:
+            await self.open()
+        if self._writer_lock.locked():
+            start = time.perf_counter()
+            await self._writer_lock.acquire()
+            self.stats.writer_waits += 1
+            self.stats.writer_wait_time += time.perf_counter() - start
+        else:
+            await self._writer_lock.acquire()
+            self.stats.writer_hits += 1
+        conn = self._writer
+        conn.row_factory = row_factory
+        try:
+            yield conn
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+        finally:
+            conn.row_factory = None
+            self._writer_lock.release()
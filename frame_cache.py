@@ -0,0 +1,54 @@
+import threading
+from typing import Union
+
+
+class TranscodeCache:
+    """Cache of resized/re-encoded frames shared by every viewer.
+
+    Entries are keyed by (stream id, target width, JPEG quality) and remember the sequence
+    number of the source frame, so each uploaded frame is transcoded at most once per
+    output format and older versions are replaced instead of piling up.
+    """
+
+    def __init__(self):
+        self._entries = dict()
+        self._lock = threading.Lock()
+        self.transcodes = 0
+        self.hits = 0
+        self.bytes_served = 0
+
+    def get(self, stream_id: str, seq: int, width: int, quality: int) -> Union[bytes, None]:
+        """Get the transcoded frame for a source frame, or None if it has not been transcoded yet."""
+        with self._lock:
+            entry = self._entries.get((stream_id, width, quality))
+            if entry is None or entry[0] != seq:
+                return None
+            self.hits += 1
+            self.bytes_served += len(entry[1])
+            return entry[1]
+
+    def put(self, stream_id: str, seq: int, width: int, quality: int, data: bytes) -> None:
+        """Store the transcoded version of a source frame."""
+        with self._lock:
+            key = (stream_id, width, quality)
+            entry = self._entries.get(key)
+            # A slower transcode of an older frame must not replace a newer one
+            if entry is None or entry[0] < seq:
+                self._entries[key] = (seq, data)
+            self.transcodes += 1
+            self.bytes_served += len(data)
+
+    def discard_stream(self, stream_id: str) -> None:
+        """Drop every cached version of a stream."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == stream_id]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "transcodes": self.transcodes,
+                "hits": self.hits,
+                "bytes_served": self.bytes_served,
+            }
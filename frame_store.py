@@ -0,0 +1,397 @@
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import List, NamedTuple, Union
+
+try:
+    import fcntl
+except ImportError:  # Windows: SharedMemoryFrameStore is not available
+    fcntl = None
+
+SQLLITE_CONN_STR = "file:framestreamerdb1?mode=memory&cache=shared"
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Shared memory store: file in /dev/shm (RAM) when it exists
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+SHM_PATH = os.path.join(SHM_DIR, "albion_frames")
+SHM_SLOTS = 64
+SHM_SLOT_SIZE = 2 * 1024 * 1024
+# Seconds between checks for frames uploaded to other processes
+SHM_POLL_INTERVAL = 0.05
+# Reads of a slot that is being written before giving up (a writer may have died mid-write)
+SHM_READ_RETRIES = 100
+SHM_MAGIC = b"ABWFRM01"
+# magic, slots, slot size
+SHM_HEADER = struct.Struct("<8sII")
+SHM_HEADER_SIZE = 64
+# Directory entry per slot: id length + UTF-8 id
+SHM_ENTRY = struct.Struct("<B63s")
+# Per slot: seqlock counter (odd while a write is in progress), frame seq, timestamp, JPEG length
+SHM_SLOT_HEADER = struct.Struct("<QQdI4x")
+
+
+class FrameTooLarge(ValueError):
+    """Raised by FrameStore.put when a frame is bigger than the store can hold."""
+
+
+class Frame(NamedTuple):
+    """A stored frame: per-stream sequence number, upload time and raw JPEG bytes."""
+    seq: int
+    timestamp: float
+    data: bytes
+
+
+class FrameStore:
+    """Interface of the frame store backends used by FrameStreamer."""
+
+    # Stores shared with other processes set how often (seconds) FrameStreamer must re-check
+    # them, since frames uploaded to another process do not wake up the local viewers.
+    poll_interval = None
+
+    def put(self, stream_id: str, data: bytes) -> Frame:
+        """Store a new frame for a stream and return it with its sequence number.
+
+        Args:
+            stream_id (str): ID of the stream
+            data (bytes): Encoded image (JPEG bytes)
+
+        Returns:
+            Frame: The stored frame
+
+        Raises:
+            FrameTooLarge: The frame does not fit in the store
+        """
+        raise NotImplementedError
+
+    def get(self, stream_id: str) -> Union[Frame, None]:
+        """Get the latest frame of a stream.
+
+        Args:
+            stream_id (str): ID of the stream
+
+        Returns:
+            Union[Frame, None]: Latest frame or None if the stream has no frames
+        """
+        raise NotImplementedError
+
+    def history(self, stream_id: str) -> List[Frame]:
+        """Get the frames kept for a stream, oldest first."""
+        frame = self.get(stream_id)
+        return [frame] if frame else []
+
+    def discard(self, stream_id: str) -> None:
+        """Drop every frame of a stream and the space it takes (nothing happens if it has none).
+
+        Args:
+            stream_id (str): ID of the stream
+        """
+        raise NotImplementedError
+
+    def stream_ids(self) -> List[str]:
+        """Get the IDs of all the streams with at least one frame."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryFrameStore(FrameStore):
+    """In-process frame store holding raw JPEG bytes.
+
+    Keeps the last `history` frames of every stream. When the stored bytes go over
+    `max_bytes`, the streams that have been idle the longest are evicted first.
+    """
+
+    def __init__(self, history: int = 1, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.history_size = max(1, history)
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.evictions = 0
+        self._streams = OrderedDict()
+        # Sequence numbers survive eviction so viewers never see a counter go backwards
+        self._seqs = dict()
+        self._lock = threading.Lock()
+
+    def put(self, stream_id: str, data: bytes) -> Frame:
+        with self._lock:
+            seq = self._seqs.get(stream_id, 0) + 1
+            self._seqs[stream_id] = seq
+            frame = Frame(seq, time.time(), data)
+
+            frames = self._streams.get(stream_id)
+            if frames is None:
+                frames = self._streams[stream_id] = deque()
+            else:
+                self._streams.move_to_end(stream_id)
+            frames.append(frame)
+            self.size_bytes += len(data)
+            if len(frames) > self.history_size:
+                self.size_bytes -= len(frames.popleft().data)
+
+            self._evict()
+            return frame
+
+    def _evict(self):
+        # Drop whole idle streams first (least recently updated), then trim the history
+        # of the active one if it alone is over the limit.
+        while self.size_bytes > self.max_bytes and len(self._streams) > 1:
+            _, frames = self._streams.popitem(last=False)
+            self.size_bytes -= sum(len(f.data) for f in frames)
+            self.evictions += 1
+        if self._streams:
+            frames = next(reversed(self._streams.values()))
+            while self.size_bytes > self.max_bytes and len(frames) > 1:
+                self.size_bytes -= len(frames.popleft().data)
+
+    def get(self, stream_id: str) -> Union[Frame, None]:
+        with self._lock:
+            frames = self._streams.get(stream_id)
+            return frames[-1] if frames else None
+
+    def history(self, stream_id: str) -> List[Frame]:
+        with self._lock:
+            return list(self._streams.get(stream_id, ()))
+
+    def discard(self, stream_id: str) -> None:
+        with self._lock:
+            frames = self._streams.pop(stream_id, ())
+            self.size_bytes -= sum(len(f.data) for f in frames)
+            self._seqs.pop(stream_id, None)
+
+    def stream_ids(self) -> List[str]:
+        with self._lock:
+            return list(self._streams)
+
+
+class SQLiteFrameStore(FrameStore):
+    """Frame store backed by SQLite (shared-cache in-memory DB by default).
+
+    Only the latest frame of each stream is kept; it is stored as a BLOB.
+    """
+
+    def __init__(self, conn_str: str = SQLLITE_CONN_STR):
+        self.conn = sqlite3.connect(conn_str, uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS frames (
+                                    id TEXT PRIMARY KEY,
+                                    seq INTEGER,
+                                    ts REAL,
+                                    image BLOB
+                                )''')
+
+    def put(self, stream_id: str, data: bytes) -> Frame:
+        now = time.time()
+        with self._lock, self.conn:
+            row = self.conn.execute('''INSERT INTO frames (id, seq, ts, image) VALUES (?, 1, ?, ?)
+                                       ON CONFLICT(id) DO UPDATE SET
+                                           seq = seq + 1, ts = excluded.ts, image = excluded.image
+                                       RETURNING seq''', (stream_id, now, data)).fetchone()
+        return Frame(row[0], now, data)
+
+    def get(self, stream_id: str) -> Union[Frame, None]:
+        try:
+            with self._lock:
+                row = self.conn.execute("SELECT seq, ts, image FROM frames WHERE id = ?", (stream_id,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return None
+        return Frame(row[0], row[1], row[2]) if row else None
+
+    def discard(self, stream_id: str) -> None:
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM frames WHERE id = ?", (stream_id,))
+
+    def stream_ids(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self.conn.execute("SELECT id FROM frames")]
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class SharedMemoryFrameStore(FrameStore):
+    """Frame store in a memory-mapped file shared by every process on the host.
+
+    Lets uvicorn run with several workers: a frame uploaded to one worker is seen by the
+    viewers connected to any other. The file has a fixed number of slots of `slot_size`
+    bytes; each stream takes one slot, holding only its latest frame.
+
+    Writers of a slot serialize with an fcntl lock on its range; readers take no lock and
+    use the slot counter as a seqlock (retry while it is odd or changed during the copy).
+    This relies on the CPU making the stores visible in program order (x86).
+    Reads copy the JPEG once out of the mapping; nothing is serialized between processes.
+
+    When every slot is taken, the stream that has been idle the longest is evicted.
+    """
+
+    poll_interval = SHM_POLL_INTERVAL
+
+    def __init__(self, path: str = SHM_PATH, slots: int = SHM_SLOTS, slot_size: int = SHM_SLOT_SIZE):
+        """
+        Args:
+            path (str, optional): Shared file. Every worker must use the same one. Defaults to SHM_PATH.
+            slots (int, optional): Maximum number of streams. Defaults to SHM_SLOTS.
+            slot_size (int, optional): Maximum JPEG size in bytes. Defaults to SHM_SLOT_SIZE.
+                Ignored (with `slots`) when the file already exists: its own header is used.
+        """
+        if fcntl is None:
+            raise RuntimeError("SharedMemoryFrameStore needs fcntl (POSIX only)")
+        self.path = path
+        self.evictions = 0
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # The first process sizes the file and writes the header
+        with self._file_lock():
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, self._file_size(slots, slot_size))
+                os.pwrite(self._fd, SHM_HEADER.pack(SHM_MAGIC, slots, slot_size), 0)
+            magic, self.slots, self.slot_size = SHM_HEADER.unpack(os.pread(self._fd, SHM_HEADER.size, 0))
+        if magic != SHM_MAGIC:
+            os.close(self._fd)
+            raise ValueError(f"{path} is not a frame store file")
+        self._mm = mmap.mmap(self._fd, self._file_size(self.slots, self.slot_size))
+        self._slots_offset = SHM_HEADER_SIZE + self.slots * SHM_ENTRY.size
+        self._slot_indexes = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _file_size(slots: int, slot_size: int) -> int:
+        return SHM_HEADER_SIZE + slots * (SHM_ENTRY.size + SHM_SLOT_HEADER.size + slot_size)
+
+    @contextmanager
+    def _file_lock(self, start: int = 0, length: int = SHM_HEADER_SIZE):
+        """Exclusive fcntl lock on a byte range of the file (the header guards the slot directory)."""
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+
+    def _slot_offset(self, index: int) -> int:
+        return self._slots_offset + index * (SHM_SLOT_HEADER.size + self.slot_size)
+
+    def _entry(self, index: int) -> str:
+        length, raw = SHM_ENTRY.unpack_from(self._mm, SHM_HEADER_SIZE + index * SHM_ENTRY.size)
+        return raw[:length].decode("utf-8")
+
+    def _find_slot(self, stream_id: str) -> Union[int, None]:
+        # The cached index is checked on every use: another process may have evicted the stream
+        index = self._slot_indexes.get(stream_id)
+        if index is not None and self._entry(index) == stream_id:
+            return index
+        self._slot_indexes.pop(stream_id, None)
+        for index in range(self.slots):
+            if self._entry(index) == stream_id:
+                self._slot_indexes[stream_id] = index
+                return index
+        return None
+
+    def _claim_slot(self, stream_id: str) -> int:
+        encoded = stream_id.encode("utf-8")
+        if len(encoded) > SHM_ENTRY.size - 1:
+            raise ValueError(f"Stream id {stream_id!r} is longer than {SHM_ENTRY.size - 1} bytes")
+        with self._file_lock():
+            # Another process may have claimed it while we waited for the lock
+            index = self._find_slot(stream_id)
+            if index is not None:
+                return index
+            entries = [self._entry(i) for i in range(self.slots)]
+            if "" in entries:
+                index = entries.index("")
+            else:
+                index = min(range(self.slots), key=self._slot_timestamp)
+                self.evictions += 1
+            offset = self._slot_offset(index)
+            with self._file_lock(offset, SHM_SLOT_HEADER.size):
+                # The seq keeps growing, so a viewer of the evicted stream never mistakes the new
+                # stream's first frame for one it already has
+                counter, seq = self._begin_write(offset)
+                SHM_ENTRY.pack_into(self._mm, SHM_HEADER_SIZE + index * SHM_ENTRY.size, len(encoded), encoded)
+                SHM_SLOT_HEADER.pack_into(self._mm, offset, counter + 1, seq, 0.0, 0)
+            self._slot_indexes[stream_id] = index
+            return index
+
+    def _begin_write(self, offset: int):
+        """Make the slot counter odd (readers retry) and return it with the frame seq.
+
+        Must be called with the slot lock held. A writer that died mid-write left the counter
+        odd already; it is kept as is, so the closing write (counter + 1) makes it even again.
+        """
+        counter, seq, _, _ = SHM_SLOT_HEADER.unpack_from(self._mm, offset)
+        counter |= 1
+        struct.pack_into("<Q", self._mm, offset, counter)
+        return counter, seq
+
+    def _slot_timestamp(self, index: int) -> float:
+        return SHM_SLOT_HEADER.unpack_from(self._mm, self._slot_offset(index))[2]
+
+    def put(self, stream_id: str, data: bytes) -> Frame:
+        if len(data) > self.slot_size:
+            raise FrameTooLarge(f"Frame of {len(data)} bytes does not fit in a slot of {self.slot_size} bytes")
+        with self._lock:
+            while True:
+                index = self._find_slot(stream_id)
+                if index is None:
+                    index = self._claim_slot(stream_id)
+                offset = self._slot_offset(index)
+                with self._file_lock(offset, SHM_SLOT_HEADER.size):
+                    # Slots are only reassigned with this lock held: if another process evicted
+                    # the stream after the lookup, look it up (or claim a slot) again
+                    if self._entry(index) != stream_id:
+                        self._slot_indexes.pop(stream_id, None)
+                        continue
+                    counter, seq = self._begin_write(offset)
+                    now = time.time()
+                    start = offset + SHM_SLOT_HEADER.size
+                    self._mm[start:start + len(data)] = data
+                    SHM_SLOT_HEADER.pack_into(self._mm, offset, counter + 1, seq + 1, now, len(data))
+                return Frame(seq + 1, now, data)
+
+    def get(self, stream_id: str) -> Union[Frame, None]:
+        index = self._find_slot(stream_id)
+        if index is None:
+            return None
+        offset = self._slot_offset(index)
+        start = offset + SHM_SLOT_HEADER.size
+        for _ in range(SHM_READ_RETRIES):
+            counter, seq, timestamp, length = SHM_SLOT_HEADER.unpack_from(self._mm, offset)
+            if counter % 2:
+                time.sleep(0)
+                continue
+            data = self._mm[start:start + length]
+            if struct.unpack_from("<Q", self._mm, offset)[0] == counter:
+                break
+        else:
+            # Still being written (or its writer died mid-write; the next put repairs it)
+            return None
+        # Empty slot (claimed, first frame not written yet) or reassigned while reading
+        if length == 0 or self._entry(index) != stream_id:
+            return None
+        return Frame(seq, timestamp, data)
+
+    def discard(self, stream_id: str) -> None:
+        with self._lock, self._file_lock():
+            index = self._find_slot(stream_id)
+            if index is None:
+                return
+            offset = self._slot_offset(index)
+            with self._file_lock(offset, SHM_SLOT_HEADER.size):
+                # Same as an eviction, but the slot is left free; the seq keeps growing
+                counter, seq = self._begin_write(offset)
+                SHM_ENTRY.pack_into(self._mm, SHM_HEADER_SIZE + index * SHM_ENTRY.size, 0, b"")
+                SHM_SLOT_HEADER.pack_into(self._mm, offset, counter + 1, seq, 0.0, 0)
+            self._slot_indexes.pop(stream_id, None)
+
+    def stream_ids(self) -> List[str]:
+        return [stream_id for stream_id in (self._entry(i) for i in range(self.slots)) if stream_id]
+
+    def close(self) -> None:
+        self._mm.close()
+        os.close(self._fd)
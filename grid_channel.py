@@ -0,0 +1,156 @@
+import asyncio
+import json
+import math
+import time
+from typing import Callable, Union
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from streamer import FrameStreamer, pack_frame_record
+
+DEFAULT_FPS = 5
+MAX_FPS = 15
+MIN_FPS = 0.5
+# Allowed thumbnail widths; requests are snapped to one of them so viewers share transcodes
+THUMBNAIL_WIDTHS = (160, 320, 480, 680)
+# How often the bot list is checked while no frame arrives
+BOTS_POLL_INTERVAL = 1.0
+
+
+def snap_width(width: int) -> int:
+    """Get the smallest allowed thumbnail width that is at least `width`."""
+    for allowed in THUMBNAIL_WIDTHS:
+        if width <= allowed:
+            return allowed
+    return THUMBNAIL_WIDTHS[-1]
+
+
+def _finite(value) -> Union[float, None]:
+    """Get `value` as a finite float, or None when it is not a number (or is nan/inf)."""
+    try:
+        value = float(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+class GridSubscription:
+    """What a grid client wants to receive and the frame rate it can currently take."""
+
+    def __init__(self):
+        self.stream_ids = set()
+        self.max_fps = DEFAULT_FPS
+        self.fps = DEFAULT_FPS
+        self.width = THUMBNAIL_WIDTHS[-1]
+
+    def update(self, message: dict) -> None:
+        """Apply a client message: {"subscribe": [ids], "fps": n, "width": px} (every key optional)."""
+        if isinstance(message.get("subscribe"), list):
+            self.stream_ids = {str(stream_id) for stream_id in message["subscribe"]}
+        if "fps" in message:
+            fps = _finite(message["fps"])
+            if fps is not None:
+                self.max_fps = min(MAX_FPS, max(MIN_FPS, fps))
+                self.fps = self.max_fps
+        if "width" in message:
+            width = _finite(message["width"])
+            if width is not None:
+                self.width = snap_width(int(width))
+
+    def adapt(self, send_time: float) -> None:
+        """Lower the rate when sending a batch took longer than the frame interval, raise it back when it is fast."""
+        interval = 1.0 / self.fps
+        if send_time > interval:
+            self.fps = max(MIN_FPS, self.fps / 2)
+        elif send_time < interval / 4 and self.fps < self.max_fps:
+            self.fps = min(self.max_fps, self.fps + 0.5)
+
+
+class GridChannel:
+    """WebSocket channel for the Monitor Grid.
+
+    Protocol:
+        client -> server (text, JSON): {"subscribe": [bot names], "fps": max fps, "width": thumbnail width}
+        server -> client (text, JSON): {"bots": [bot names], "online": [online bot names]} on connect and
+            whenever a bot is added or removed or goes online/offline
+        server -> client (binary): one or more frame records (see streamer.pack_frame_record)
+    """
+
+    def __init__(self, streamer: FrameStreamer, bot_names: Callable[[], list], bots_version: Callable[[], int],
+                 online_names: Callable[[], list] = None):
+        """
+        Args:
+            streamer (FrameStreamer): Frame source
+            bot_names (Callable[[], list]): Returns the names of the registered bots
+            bots_version (Callable[[], int]): Returns a number that changes whenever the bot list changes
+            online_names (Callable[[], list], optional): Returns the names of the bots that are online,
+                checked every BOTS_POLL_INTERVAL. Defaults to None (every bot is reported online).
+        """
+        self.streamer = streamer
+        self.bot_names = bot_names
+        self.bots_version = bots_version
+        self.online_names = online_names
+        self.clients = 0
+
+    async def serve(self, websocket: WebSocket) -> None:
+        """Handle one grid client until it disconnects."""
+        await websocket.accept()
+        subscription = GridSubscription()
+        self.clients += 1
+        receiver = asyncio.create_task(self._receive(websocket, subscription))
+        sender = asyncio.create_task(self._send(websocket, subscription))
+        try:
+            await asyncio.wait((receiver, sender), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.clients -= 1
+            receiver.cancel()
+            sender.cancel()
+            await asyncio.gather(receiver, sender, return_exceptions=True)
+
+    async def _receive(self, websocket: WebSocket, subscription: GridSubscription) -> None:
+        try:
+            while True:
+                try:
+                    message = json.loads(await websocket.receive_text())
+                    if isinstance(message, dict):
+                        subscription.update(message)
+                except (TypeError, ValueError):
+                    continue
+        except (WebSocketDisconnect, RuntimeError, OSError):
+            return
+
+    async def _send(self, websocket: WebSocket, subscription: GridSubscription) -> None:
+        last_seqs = dict()
+        last_version = None
+        last_online = None
+        online_checked = 0.0
+        try:
+            while True:
+                version = self.bots_version()
+                online = last_online
+                if self.online_names is not None and time.monotonic() - online_checked >= BOTS_POLL_INTERVAL:
+                    online_checked = time.monotonic()
+                    online = self.online_names()
+                if version != last_version or online != last_online:
+                    last_version = version
+                    last_online = online
+                    names = self.bot_names()
+                    await websocket.send_json({"bots": names, "online": names if online is None else online})
+
+                started = time.monotonic()
+                changed = self.streamer.changed_frames(subscription.stream_ids, last_seqs)
+                if not changed:
+                    try:
+                        await asyncio.wait_for(self.streamer.wait_any_frame(), BOTS_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                batch = await self.streamer.transcode_batch(changed, last_seqs, subscription.width)
+                if batch:
+                    sending = time.monotonic()
+                    await websocket.send_bytes(b''.join(pack_frame_record(*frame) for frame in batch))
+                    subscription.adapt(time.monotonic() - sending)
+                await asyncio.sleep(max(0.0, 1.0 / subscription.fps - (time.monotonic() - started)))
+        except (WebSocketDisconnect, RuntimeError, OSError):
+            return
@@ -0,0 +1,162 @@
+import asyncio
+import datetime
+import time
+
+import database
+
+# Valores por defecto de la cola de ingesta
+MAX_BATCH = 500          # Número de eventos que dispara un flush inmediato
+MAX_DELAY = 0.5          # Segundos máximos que un evento espera en la cola
+MAX_QUEUE = 10000        # Tamaño máximo de la cola antes de aplicar back-pressure
+FLUSH_RETRIES = 3
+
+
+class IngestStats:
+    """Contadores de la cola de ingesta."""
+
+    def __init__(self):
+        self.enqueued = 0
+        self.blocked_puts = 0
+        self.batches = 0
+        self.transactions = 0
+        self.temp_updates = 0
+        self.coalesced_temps = 0
+        self.failed_batches = 0
+        self.last_flush_time = 0.0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class IngestQueue:
+    """
+        Cola asíncrona de escritura diferida para transacciones y temperaturas.
+
+        Los endpoints encolan los eventos y vuelven de inmediato; una tarea en segundo plano
+        los agrupa y los escribe con database.insert_batch_transactions en un único commit
+        cuando se juntan MAX_BATCH eventos o pasan MAX_DELAY segundos desde el primero.
+        Las actualizaciones de temperatura de un mismo bot dentro de un lote se fusionan
+        y solo se guarda la última.
+    """
+
+    def __init__(self, max_batch: int = MAX_BATCH, max_delay: float = MAX_DELAY, maxsize: int = MAX_QUEUE):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.stats = IngestStats()
+        self._queue = asyncio.Queue(maxsize)
+        self._task = None
+
+    async def start(self):
+        """
+            Arranca la tarea que vacía la cola.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+            Escribe todo lo pendiente y detiene la tarea. Se llama al apagar el servidor.
+        """
+        if self._task is None:
+            await self.flush()
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def depth(self) -> int:
+        """
+            Eventos encolados que todavía no se escriben.
+        """
+        return self._queue.qsize()
+
+    async def _put(self, item):
+        self.stats.enqueued += 1
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # Back-pressure: el cliente espera hasta que el flush libere espacio
+            self.stats.blocked_puts += 1
+            await self._queue.put(item)
+
+    async def add_transaction(self, bot_name: str, quantity: int, date=None):
+        """
+            Encola una transacción. La fecha se fija en el momento de encolar.
+        """
+        if date is None:
+            date = datetime.datetime.now()
+        await self._put(("transaction", bot_name, quantity, date))
+
+    async def update_temp(self, bot_name: str, new_temp: int):
+        """
+            Encola una actualización de temperatura.
+        """
+        await self._put(("temp", bot_name, new_temp))
+
+    def _drain(self, first=None):
+        items = [] if first is None else [first]
+        while len(items) < self.max_batch:
+            try:
+                items.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return items
+
+    async def flush(self):
+        """
+            Escribe de inmediato todo lo que haya en la cola.
+        """
+        items = self._drain()
+        while items:
+            await self._write(items)
+            items = self._drain()
+
+    async def _run(self):
+        while True:
+            first = await self._queue.get()
+            deadline = time.monotonic() + self.max_delay
+            items = [first]
+            while len(items) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._write(items)
+
+    async def _write(self, items):
+        transactions = list()
+        temps = dict()
+        for item in items:
+            if item[0] == "transaction":
+                transactions.append(item[1:])
+            else:
+                if item[1] in temps:
+                    self.stats.coalesced_temps += 1
+                temps[item[1]] = item[2]
+
+        start = time.perf_counter()
+        try:
+            for attempt in range(FLUSH_RETRIES):
+                try:
+                    await database.insert_batch_transactions(transactions, temps)
+                    break
+                except Exception as e:
+                    print(f"Error escribiendo el lote de ingesta (intento {attempt + 1}): {e}")
+                    if attempt + 1 == FLUSH_RETRIES:
+                        self.stats.failed_batches += 1
+                        return
+                    await asyncio.sleep(0.1 * (attempt + 1))
+            self.stats.batches += 1
+            self.stats.transactions += len(transactions)
+            self.stats.temp_updates += len(temps)
+            self.stats.last_flush_time = round(time.perf_counter() - start, 6)
+        finally:
+            for _ in items:
+                self._queue.task_done()
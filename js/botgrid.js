@@ -1,93 +1,190 @@
-const streamEndpoint = '/base64_stream';
-let controller = new AbortController();
+const gridEndpoint = `${location.protocol === 'https:' ? 'wss' : 'ws'}://${location.host}/ws/grid`;
+const maxFps = 5;
+let socket = null;
+let reconnectTimer = null;
 
-function checkImage(base64string) {
-  if (base64string.length % 4 !== 0) {
-    return false;
+// Registro binario: u16 largo del id, id (UTF-8), u32 secuencia, u32 largo del JPEG, JPEG
+const ID_HEADER_SIZE = 2;
+const FRAME_HEADER_SIZE = 8;
+const textDecoder = new TextDecoder();
+const objectUrls = {};
+const visibleBots = new Set();
+
+function processFrame(id, jpegBytes) {
+  const imgElement = document.getElementById(id);
+  if (!imgElement) {
+    return;
   }
 
-  try {
-    const imageData = Uint8Array.from(atob(base64string), c => c.charCodeAt(0));
-    return imageData[imageData.length - 2] === 255 && imageData[imageData.length - 1] === 217;
-  } catch (error) {
-    //console.error('Error verificando la imagen base64:', error);
-    return false;
+  const url = URL.createObjectURL(new Blob([jpegBytes], { type: 'image/jpeg' }));
+  imgElement.src = url;
+  // Libera la imagen anterior de este bot
+  if (objectUrls[id]) {
+    URL.revokeObjectURL(objectUrls[id]);
   }
+  objectUrls[id] = url;
 }
 
-async function processStreamData(data) {
-  const [id, base64_frame] = data.split(':');
+// Procesa todos los registros de un mensaje binario
+function parseRecords(buffer) {
+  const view = new DataView(buffer.buffer, buffer.byteOffset, buffer.byteLength);
+  let offset = 0;
 
-  const imgElement = document.getElementById(id);
-  if (imgElement) {
-    imgElement.src = `data:image/jpeg;base64,${base64_frame}`;
+  while (buffer.length - offset >= ID_HEADER_SIZE) {
+    const idLength = view.getUint16(offset);
+    const headerEnd = offset + ID_HEADER_SIZE + idLength + FRAME_HEADER_SIZE;
+    if (buffer.length < headerEnd) {
+      break;
+    }
+    const id = textDecoder.decode(buffer.subarray(offset + ID_HEADER_SIZE, offset + ID_HEADER_SIZE + idLength));
+    const jpegLength = view.getUint32(headerEnd - 4);
+    if (buffer.length < headerEnd + jpegLength) {
+      break;
+    }
+    processFrame(id, buffer.subarray(headerEnd, headerEnd + jpegLength));
+    offset = headerEnd + jpegLength;
   }
 }
 
-async function consumeStream() {
-  const signal = controller.signal;
-  let last_string = '';
+// Solo se piden los bots cuya tarjeta está en pantalla
+const visibilityObserver = new IntersectionObserver((entries) => {
+  for (const entry of entries) {
+    const name = entry.target.dataset.bot;
+    if (entry.isIntersecting) {
+      visibleBots.add(name);
+    } else {
+      visibleBots.delete(name);
+    }
+  }
+  sendSubscription();
+});
+
+function thumbnailWidth() {
+  const img = document.querySelector('#botCards img');
+  const width = img ? img.clientWidth : 340;
+  return Math.round(width * (window.devicePixelRatio || 1));
+}
+
+function sendSubscription() {
+  if (!socket || socket.readyState !== WebSocket.OPEN) {
+    return;
+  }
+  const subscribe = document.hidden ? [] : Array.from(visibleBots);
+  socket.send(JSON.stringify({ subscribe: subscribe, fps: maxFps, width: thumbnailWidth() }));
+}
+
+// Mismo badge que templates/home.html
+function setBadge(badge, online) {
+  badge.className = `badge ${online ? 'bg-success' : 'bg-secondary'}`;
+  badge.textContent = online ? 'online' : 'offline';
+}
+
+function createCard(name, placeholder, online) {
+  const card = document.createElement('div');
+  card.className = 'col-md-3 mb-4';
+  card.dataset.bot = name;
+
+  const inner = document.createElement('div');
+  inner.className = 'card text-white bg-dark h-100';
 
-  try {
-    const response = await fetch(streamEndpoint, { signal });
-    const reader = response.body.getReader();
-    const decoder = new TextDecoder();
+  const link = document.createElement('a');
+  link.href = `/bot_details/${encodeURIComponent(name)}`;
+  link.className = 'stretched-link';
 
-    while (true) {
-      const { done, value } = await reader.read();
-      if (done) break;
+  const img = document.createElement('img');
+  img.className = 'card-img-top';
+  img.id = name;
+  img.src = placeholder;
+  img.alt = '';
+  link.appendChild(img);
 
-      const chunk = decoder.decode(value, { stream: true });
-      const base64Strings = chunk.split(' ');
+  const footer = document.createElement('div');
+  footer.className = 'card-footer text-center';
+  const title = document.createElement('p');
+  title.className = 'card-title mb-0';
+  const badge = document.createElement('span');
+  setBadge(badge, online);
+  title.append(name, ' ', badge);
+  footer.appendChild(title);
 
-      for (let base64String of base64Strings) {
-        if (last_string.length > 0) {
-          base64String = last_string.concat(base64String);
-        }
+  inner.appendChild(link);
+  inner.appendChild(footer);
+  card.appendChild(inner);
+  return card;
+}
 
-        let [_, base64_frame] = base64String.split(':');
+// Agrega y quita tarjetas para que la rejilla coincida con la lista de bots del servidor
+function updateBots(names, online) {
+  const container = document.getElementById('botCards');
+  const wanted = new Set(names);
+  const onlineBots = new Set(online || names);
 
-        if (checkImage(base64_frame)) {
-          last_string = '';
-          await processStreamData(base64String);
-        }
-        else {
-          last_string = base64String;
-        }
+  for (const card of Array.from(container.querySelectorAll('[data-bot]'))) {
+    const name = card.dataset.bot;
+    if (!wanted.has(name)) {
+      visibilityObserver.unobserve(card);
+      visibleBots.delete(name);
+      if (objectUrls[name]) {
+        URL.revokeObjectURL(objectUrls[name]);
+        delete objectUrls[name];
       }
+      card.remove();
     }
-  } catch (error) {
-    if (error.name === 'AbortError') {
-      console.log('La conexión fue abortada.');
+  }
+
+  const cards = new Map(Array.from(container.querySelectorAll('[data-bot]')).map(card => [card.dataset.bot, card]));
+  for (const name of [...names].sort()) {
+    let card = cards.get(name);
+    if (!card) {
+      card = createCard(name, container.dataset.placeholder, onlineBots.has(name));
+      visibilityObserver.observe(card);
     } else {
-      console.error('Error en la lectura del flujo:', error);
-      reconnectStream(); // Intentar reconectar si hay un error
+      const badge = card.querySelector('.card-title .badge');
+      if (badge) {
+        setBadge(badge, onlineBots.has(name));
+      }
     }
+    container.appendChild(card); // Mantiene el orden alfabético
   }
+  sendSubscription();
 }
 
-function handleVisibilityChange() {
-  if (!document.hidden || document.visibilityState === 'visible') {
-    controller.abort();
-    controller = new AbortController();
-    consumeStream();
-  } else {
-    controller.abort();
-  }
+function connect() {
+  socket = new WebSocket(gridEndpoint);
+  socket.binaryType = 'arraybuffer';
+
+  socket.onopen = sendSubscription;
+
+  socket.onmessage = (event) => {
+    if (typeof event.data === 'string') {
+      const message = JSON.parse(event.data);
+      if (message.bots) {
+        updateBots(message.bots, message.online);
+      }
+    } else {
+      parseRecords(new Uint8Array(event.data));
+    }
+  };
+
+  socket.onclose = () => {
+    console.log('La conexión fue cerrada.');
+    reconnectStream();
+  };
 }
 
 function reconnectStream() {
   // Esperar antes de intentar reconectar
-  setTimeout(() => {
-    controller = new AbortController();
-    consumeStream();
-  }, 5000); // Reintentar después de 5 segundos
+  clearTimeout(reconnectTimer);
+  reconnectTimer = setTimeout(connect, 5000); // Reintentar después de 5 segundos
 }
 
-if (typeof document.hidden !== "undefined") {
-  document.addEventListener("visibilitychange", handleVisibilityChange);
-}
+// Con la pestaña oculta no se pide ningún bot
+document.addEventListener("visibilitychange", sendSubscription);
+window.addEventListener("resize", sendSubscription);
 
 window.onload = function() {
-  consumeStream();
-};
\ No newline at end of file
+  for (const card of document.querySelectorAll('#botCards [data-bot]')) {
+    visibilityObserver.observe(card);
+  }
+  connect();
+};
@@ -0,0 +1,25 @@
+// Convierte un clic sobre el mosaico en el bot de ese mosaico y abre su página de detalles
+async function openClickedBot(event) {
+  const img = event.currentTarget;
+  const response = await fetch(img.dataset.layout, { cache: 'no-store' });
+  const layout = await response.json();
+
+  const rect = img.getBoundingClientRect();
+  // Coordenadas del clic en píxeles de la imagen original
+  const x = (event.clientX - rect.left) * (img.naturalWidth / rect.width);
+  const y = (event.clientY - rect.top) * (img.naturalHeight / rect.height);
+  const column = Math.floor(x / layout.tile_width);
+  const row = Math.floor(y / layout.tile_height);
+  if (column >= layout.columns) {
+    return;
+  }
+
+  const bot = layout.bots[row * layout.columns + column];
+  if (bot !== undefined) {
+    window.location.href = `/bot_details/${encodeURIComponent(bot)}`;
+  }
+}
+
+window.onload = function() {
+  document.getElementById('mosaic').addEventListener('click', openClickedBot);
+};
@@ -0,0 +1,157 @@
+// Gráficos de bot_details y del dashboard. Los datos se piden a /api/stats/* y se vuelven a
+// pedir cada minuto; si no cambiaron el servidor responde 304 y no se toca nada.
+// El estado del bot (temperatura, online, IP, mapa) y los bots trabados salen de /api/bots y
+// /stream_status, que no tocan la base, y se refrescan más seguido.
+const statsBot = document.currentScript.dataset.bot || '';
+const refreshInterval = 60000;
+const statusInterval = 10000;
+const etags = {};
+
+function statsUrl(kind) {
+  return statsBot ? `/api/stats/${kind}?bot=${encodeURIComponent(statsBot)}` : `/api/stats/${kind}`;
+}
+
+// Devuelve el JSON nuevo o null si no cambió desde la última vez
+async function fetchChanged(kind) {
+  const headers = etags[kind] ? { 'If-None-Match': etags[kind] } : {};
+  const response = await fetch(statsUrl(kind), { headers: headers, cache: 'no-store' });
+  if (response.status === 304 || !response.ok) {
+    return null;
+  }
+  etags[kind] = response.headers.get('ETag');
+  return response.json();
+}
+
+function createChart(id, label, color) {
+  return new Chart(document.getElementById(id), {
+    type: 'bar',
+    data: {
+      labels: [],
+      datasets: [{
+        label: label,
+        data: [],
+        borderWidth: 1,
+        backgroundColor: `rgba(${color}, 0.2)`,
+        borderColor: `rgba(${color}, 1)`,
+      }]
+    },
+    options: {
+      scales: {
+        y: {
+          beginAtZero: true
+        }
+      }
+    }
+  });
+}
+
+function setChartData(chart, labels, values) {
+  chart.data.labels = labels;
+  chart.data.datasets[0].data = values;
+  chart.update();
+}
+
+function setText(id, text) {
+  const element = document.getElementById(id);
+  if (element) {
+    element.textContent = text;
+  }
+}
+
+async function refreshStats(charts) {
+  try {
+    const [monthly, daily, summary] = await Promise.all([
+      fetchChanged('monthly'), fetchChanged('daily'), fetchChanged('summary')
+    ]);
+    if (monthly) {
+      setChartData(charts.monthly, monthly.map(m => m.name), monthly.map(m => m.quantity));
+    }
+    if (daily) {
+      setChartData(charts.daily, daily.map(d => d.day), daily.map(d => d.quantity));
+    }
+    if (summary) {
+      setText('avgYear', summary.avg_year_display);
+      setText('clpAvgYear', summary.clp_avg_year);
+      setText('avgThisMonth', summary.avg_this_month_display);
+    }
+  } catch (error) {
+    console.log('No se pudieron actualizar las estadísticas.', error);
+  }
+}
+
+async function fetchJson(url) {
+  const response = await fetch(url, { cache: 'no-store' });
+  return response.ok ? response.json() : null;
+}
+
+function showElement(id, visible) {
+  const element = document.getElementById(id);
+  if (element) {
+    element.classList.toggle('d-none', !visible);
+  }
+}
+
+function setStuckBots(status) {
+  const list = document.getElementById('stuckBotsList');
+  if (!list) {
+    return;
+  }
+  const stuck = Object.keys(status).filter(name => status[name].stuck).sort();
+  list.replaceChildren(...stuck.map(name => {
+    const item = document.createElement('li');
+    item.className = 'list-group-item';
+    const link = document.createElement('a');
+    link.href = `/bot_details/${encodeURIComponent(name)}`;
+    link.textContent = name;
+    item.append(link, `: frame unchanged for ${Math.floor(status[name].unchanged_for)}s`);
+    return item;
+  }));
+  showElement('stuckBots', stuck.length > 0);
+}
+
+function setBotDetails(bot, streamStatus) {
+  setText('botTemp', bot.temp);
+  setText('botStatus', bot.online ? 'Online' : 'Offline');
+  setText('botLocalIp', bot.local_ip);
+  setText('botGatheringMap', bot.gathering_map);
+  const stuck = streamStatus !== undefined && streamStatus.stuck;
+  if (stuck) {
+    setText('botUnchangedFor', Math.floor(streamStatus.unchanged_for));
+  }
+  showElement('botStuck', stuck);
+}
+
+async function refreshStatus() {
+  try {
+    const [bots, status] = await Promise.all([
+      statsBot ? fetchJson('/api/bots') : Promise.resolve(null), fetchJson('/stream_status')
+    ]);
+    if (status) {
+      setStuckBots(status);
+    }
+    const bot = bots && bots.find(b => b.name === statsBot);
+    if (bot) {
+      setBotDetails(bot, status ? status[statsBot] : undefined);
+    }
+  } catch (error) {
+    console.log('No se pudo actualizar el estado de los bots.', error);
+  }
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+  const charts = {
+    monthly: createChart('monthlyChart', 'Silver per Month', '75, 192, 192'),
+    daily: createChart('dailyChart', 'Total silver per Day', '153, 102, 255'),
+  };
+  refreshStats(charts);
+  setInterval(() => {
+    if (!document.hidden) {
+      refreshStats(charts);
+    }
+  }, refreshInterval);
+  setInterval(() => {
+    if (!document.hidden) {
+      refreshStatus();
+    }
+  }, statusInterval);
+});
@@ -0,0 +1,280 @@
+import asyncio
+import bisect
+import functools
+import os
+import time
+
+# Default bucket upper bounds (in seconds) for timing histograms
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Comma separated subsystems to disable at startup, e.g. METRICS_DISABLED=db,http
+DISABLED_ENV = "METRICS_DISABLED"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LOOP_LAG_INTERVAL = 0.5
+
+
+class Histogram:
+    """Histogram with fixed bucket upper bounds (counts are per bucket, not cumulative)."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile (inf if it is above the last bucket)."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": {str(b): n for b, n in zip(self.buckets + ("+Inf",), self.counts)},
+        }
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+
+class Family:
+    """A named metric with one child (Counter, Gauge or Histogram) per combination of label values."""
+
+    def __init__(self, kind: str, name: str, documentation: str, labels=(), factory=None, function=None):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.factory = factory
+        # Values can be sampled at scrape time instead of being updated on the hot path.
+        # function returns a number, or {label values tuple: number} for labeled families.
+        self.function = function
+        self._children = dict()
+
+    def labels(self, *values):
+        """Get the child for these label values (created on first use)."""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self.factory()
+        return child
+
+    def remove(self, *values) -> None:
+        """Drop the child for these label values (e.g. when the thing it measures is deleted)."""
+        self._children.pop(values, None)
+
+    def children(self):
+        if self.function is not None:
+            value = self.function()
+            if isinstance(value, dict):
+                return [(values, _Sample(v)) for values, v in value.items()]
+            return [((), _Sample(value))]
+        return list(self._children.items())
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, child in self.children():
+            labels = _format_labels(self.label_names, values)
+            if isinstance(child, Histogram):
+                cumulative = 0
+                for bound, n in zip(child.buckets, child.counts):
+                    cumulative += n
+                    yield f"{self.name}_bucket{_format_labels(self.label_names + ('le',), values + (bound,))} {cumulative}"
+                yield f"{self.name}_bucket{_format_labels(self.label_names + ('le',), values + ('+Inf',))} {child.count}"
+                yield f"{self.name}_sum{labels} {child.sum}"
+                yield f"{self.name}_count{labels} {child.count}"
+            else:
+                yield f"{self.name}{labels} {child.value}"
+
+
+class _Sample:
+    def __init__(self, value):
+        self.value = value
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = (f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Subsystem:
+    """Group of metrics that can be switched off together.
+
+    Instrumented code checks `enabled` before measuring, so a disabled subsystem costs one
+    attribute lookup per call and is left out of the exposition.
+    """
+
+    def __init__(self, name: str, enabled: bool = True):
+        self.name = name
+        self.enabled = enabled
+        self.families = dict()
+
+    def counter(self, name: str, documentation: str, labels=(), function=None) -> Family:
+        return self._add(Family("counter", name, documentation, labels, Counter, function))
+
+    def gauge(self, name: str, documentation: str, labels=(), function=None) -> Family:
+        return self._add(Family("gauge", name, documentation, labels, Gauge, function))
+
+    def histogram(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS) -> Family:
+        return self._add(Family("histogram", name, documentation, labels, lambda: Histogram(buckets)))
+
+    def _add(self, family: Family) -> Family:
+        # Registering the same name again returns the existing family
+        return self.families.setdefault(family.name, family)
+
+
+class Registry:
+    """All the subsystems of the application, rendered together in Prometheus text format."""
+
+    def __init__(self, disabled=()):
+        self.disabled = set(disabled)
+        self._subsystems = dict()
+
+    def subsystem(self, name: str) -> Subsystem:
+        """Get a subsystem by name (created on first use, enabled unless listed in `disabled`)."""
+        subsystem = self._subsystems.get(name)
+        if subsystem is None:
+            subsystem = self._subsystems[name] = Subsystem(name, name not in self.disabled)
+        return subsystem
+
+    def set_enabled(self, name: str, enabled: bool) -> None:
+        self.subsystem(name).enabled = enabled
+
+    def status(self) -> dict:
+        return {name: s.enabled for name, s in sorted(self._subsystems.items())}
+
+    def render(self) -> str:
+        lines = list()
+        for subsystem in self._subsystems.values():
+            if subsystem.enabled:
+                for family in subsystem.families.values():
+                    lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry(filter(None, os.environ.get(DISABLED_ENV, "").split(",")))
+
+
+def timed(subsystem: Subsystem, family: Family):
+    """Decorator recording the duration of an async function in `family`, labeled with its name."""
+
+    def decorator(func):
+        histogram = family.labels(func.__name__)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not subsystem.enabled:
+                return await func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware timing every HTTP request until its response starts, per route template.
+
+    For streaming responses this is the time to the first byte.
+    """
+
+    def __init__(self, app, subsystem: Subsystem):
+        self.app = app
+        self.subsystem = subsystem
+        self.latency = subsystem.histogram("http_request_duration_seconds",
+                                           "Time until the response starts, per route", ("method", "route"))
+        self.responses = subsystem.counter("http_responses_total", "Responses per route and status",
+                                           ("method", "route", "status"))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.subsystem.enabled:
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                # The router stores the matched route in the scope; unmatched paths share one label
+                route = scope.get("route")
+                path = route.path if route is not None else "unmatched"
+                self.latency.labels(scope["method"], path).observe(time.perf_counter() - start)
+                self.responses.labels(scope["method"], path, message["status"]).inc()
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from a periodic sleep."""
+
+    def __init__(self, subsystem: Subsystem, interval: float = LOOP_LAG_INTERVAL):
+        self.subsystem = subsystem
+        self.interval = interval
+        self.lag = subsystem.gauge("event_loop_lag_seconds", "Delay of the last periodic wake-up of the event loop")
+        self.distribution = subsystem.histogram("event_loop_lag_distribution_seconds",
+                                                "Delays of the periodic wake-ups of the event loop")
+        self.max_delay = 0.0
+
+    async def run(self):
+        """Runs until cancelled (started from the application lifespan)."""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            delay = max(0.0, loop.time() - expected)
+            if self.subsystem.enabled:
+                self.lag.labels().set(delay)
+                self.distribution.labels().observe(delay)
+                self.max_delay = max(self.max_delay, delay)
+
+    def report(self) -> dict:
+        """Summary of the delays measured so far, in ms (p99 is a histogram bucket bound, capped at the max)."""
+        histogram = self.distribution.labels()
+        if histogram.count == 0:
+            return {}
+        return {
+            "mean_ms": round(histogram.sum / histogram.count * 1000, 2),
+            "p99_ms": round(min(histogram.quantile(0.99), self.max_delay) * 1000, 2),
+            "max_ms": round(self.max_delay * 1000, 2),
+        }
@@ -0,0 +1,152 @@
+import asyncio
+import math
+import time
+from typing import List, Union
+
+import cv2
+import numpy as np
+
+from frame_store import Frame
+
+DEFAULT_COLUMNS = 4
+DEFAULT_TILE_WIDTH = 320
+MAX_COLUMNS = 12
+MIN_TILE_WIDTH = 80
+MAX_TILE_WIDTH = 680
+# Tile widths are rounded to this step so there are only a few distinct mosaics to build
+TILE_WIDTH_STEP = 40
+MOSAIC_QUALITY = 80
+# Mosaic builders kept by a FrameStreamer; the least recently used one is dropped beyond this
+MAX_MOSAICS = 8
+
+
+def tile_height(tile_width: int) -> int:
+    """Tiles use the 16:9 aspect ratio of the game client."""
+    return tile_width * 9 // 16
+
+
+def normalize_layout(columns: int, tile_width: int):
+    """Clamp and round a requested mosaic configuration to a supported one."""
+    columns = min(MAX_COLUMNS, max(1, columns))
+    tile_width = min(MAX_TILE_WIDTH, max(MIN_TILE_WIDTH, tile_width))
+    tile_width = round(tile_width / TILE_WIDTH_STEP) * TILE_WIDTH_STEP
+    return columns, tile_width
+
+
+def layout_info(stream_ids: List[str], columns: int, tile_width: int) -> dict:
+    """Description of the tiles of a mosaic, used by the page to map clicks to bots."""
+    return {
+        "columns": columns,
+        "rows": max(1, math.ceil(len(stream_ids) / columns)),
+        "tile_width": tile_width,
+        "tile_height": tile_height(tile_width),
+        "bots": list(stream_ids),
+    }
+
+
+def render_tile(data: bytes, width: int, height: int, label: str) -> Union[np.ndarray, None]:
+    """Decode a frame and fit it (letterboxed) into a width x height tile with its label
+
+    Args:
+        data (bytes): Encoded image
+        width (int): Tile width
+        height (int): Tile height
+        label (str): Text drawn in the corner of the tile (the bot name)
+
+    Returns:
+        Union[np.ndarray, None]: BGR tile or None if the image could not be decoded
+    """
+    frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        return None
+    scale = min(width / frame.shape[1], height / frame.shape[0])
+    w, h = max(1, int(frame.shape[1] * scale)), max(1, int(frame.shape[0] * scale))
+    tile = np.zeros((height, width, 3), np.uint8)
+    x, y = (width - w) // 2, (height - h) // 2
+    tile[y:y + h, x:x + w] = cv2.resize(frame, (w, h), interpolation=cv2.INTER_AREA)
+    cv2.putText(tile, label, (6, height - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (255, 255, 255), 1, cv2.LINE_AA)
+    return tile
+
+
+def encode_image(image: np.ndarray, quality: int) -> Union[bytes, None]:
+    """Encode an image as JPEG (worker pool function)."""
+    flag, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return encoded.tobytes() if flag else None
+
+
+class MosaicBuilder:
+    """Builds one tiled JPEG with the latest frame of every stream.
+
+    The canvas is kept between updates and only the tiles whose source frame changed are
+    redrawn. All the viewers of the same configuration share one builder, so the mosaic is
+    encoded once per change no matter how many viewers there are.
+    """
+
+    def __init__(self, streamer, columns: int = DEFAULT_COLUMNS, tile_width: int = DEFAULT_TILE_WIDTH,
+                 quality: int = MOSAIC_QUALITY):
+        """
+        Args:
+            streamer (FrameStreamer): Source of the frames and owner of the worker pool
+            columns (int, optional): Tiles per row. Defaults to DEFAULT_COLUMNS.
+            tile_width (int, optional): Width of each tile. Defaults to DEFAULT_TILE_WIDTH.
+            quality (int, optional): JPEG quality of the mosaic. Defaults to MOSAIC_QUALITY.
+        """
+        self.streamer = streamer
+        self.columns = columns
+        self.tile_width = tile_width
+        self.tile_height = tile_height(tile_width)
+        self.quality = quality
+        self.layout = list()
+        self.canvas = None
+        self.frame = None
+        self.tiles_drawn = 0
+        self._tile_seqs = dict()
+        self._seq = 0
+        self._lock = asyncio.Lock()
+
+    def _relayout(self, stream_ids: List[str]) -> None:
+        self.layout = list(stream_ids)
+        rows = max(1, math.ceil(len(self.layout) / self.columns))
+        self.canvas = np.zeros((rows * self.tile_height, self.columns * self.tile_width, 3), np.uint8)
+        self._tile_seqs = dict()
+        self.frame = None
+
+    def tile_origin(self, index: int):
+        row, column = divmod(index, self.columns)
+        return column * self.tile_width, row * self.tile_height
+
+    async def update(self, stream_ids: List[str]) -> Union[Frame, None]:
+        """Redraw the tiles that changed and return the latest mosaic
+
+        Args:
+            stream_ids (List[str]): Streams to show, in tile order
+
+        Returns:
+            Union[Frame, None]: Latest mosaic (its seq only changes when a tile changed)
+        """
+        async with self._lock:
+            if list(stream_ids) != self.layout or self.canvas is None:
+                self._relayout(stream_ids)
+
+            changed = self.streamer.changed_frames(self.layout, self._tile_seqs)
+            if not changed and self.frame is not None:
+                return self.frame
+
+            tiles = await asyncio.gather(*(self.streamer.run_in_pool(render_tile, stored.data, self.tile_width,
+                                                                     self.tile_height, stream_id)
+                                           for stream_id, stored in changed),
+                                         return_exceptions=True)
+            for (stream_id, stored), tile in zip(changed, tiles):
+                self._tile_seqs[stream_id] = stored.seq
+                if tile is None or isinstance(tile, Exception):
+                    continue
+                x, y = self.tile_origin(self.layout.index(stream_id))
+                self.canvas[y:y + self.tile_height, x:x + self.tile_width] = tile
+                self.tiles_drawn += 1
+
+            # The canvas is not touched while it is being encoded: the lock is held
+            data = await self.streamer.run_in_pool(encode_image, self.canvas, self.quality)
+            if data is not None:
+                self._seq += 1
+                self.frame = Frame(self._seq, time.time(), data)
+            return self.frame
@@ -0,0 +1,174 @@
+import time
+from typing import Union
+
+import database
+from timeseries import TEMP
+
+# Segundos sin noticias de un bot (temperatura, login, imagen o transacción) para considerarlo offline
+HEARTBEAT_TIMEOUT = 30
+
+
+class BotState:
+    """
+        Estado en vivo de un bot. Los campos de la tabla "Bots" se guardan también en SQLite;
+        last_seen y last_frame solo viven en memoria.
+    """
+
+    __slots__ = ("id", "name", "local_ip", "temp", "gathering_map", "last_seen", "last_frame")
+
+    def __init__(self, bot_id: int, name: str, local_ip: str, temp: int, gathering_map: str):
+        self.id = bot_id
+        self.name = name
+        self.local_ip = local_ip
+        self.temp = temp
+        self.gathering_map = gathering_map
+        self.last_seen = None
+        self.last_frame = None
+
+    def as_dict(self, now: float, heartbeat_timeout: float) -> dict:
+        online = self.last_seen is not None and now - self.last_seen < heartbeat_timeout
+        return {
+            "id": self.id,
+            "name": self.name,
+            "local_ip": self.local_ip,
+            "temp": self.temp,
+            "gathering_map": self.gathering_map,
+            "last_seen": self.last_seen,
+            "last_frame": self.last_frame,
+            "online": online,
+        }
+
+
+class BotRegistry:
+    """
+        Registro en memoria de todos los bots con su estado en vivo.
+
+        Las lecturas (página principal, detalles, /api/bots) no tocan SQLite. Las escrituras solo
+        llegan a la base de datos cuando un valor cambia: la temperatura va por la cola de ingesta
+        (que agrupa y coalesce), y la IP y el mapa, que cambian muy poco, se escriben en el momento.
+    """
+
+    def __init__(self, ingest_queue, telemetry=None, heartbeat_timeout: float = HEARTBEAT_TIMEOUT):
+        self.ingest_queue = ingest_queue
+        self.telemetry = telemetry
+        self.heartbeat_timeout = heartbeat_timeout
+        self._bots = dict()
+        self.heartbeats = 0
+        self.skipped_writes = 0
+
+    async def load(self):
+        """
+            Carga los bots de la tabla "Bots". Se llama al iniciar, después de database.init().
+        """
+        rows = await database.fetch_all_bots()
+        self._bots = {row['name']: BotState(row['id'], row['name'], row['local_ip'], row['temp'],
+                                            row['gathering_map'])
+                      for row in rows}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._bots
+
+    def get(self, name: str) -> Union[dict, None]:
+        state = self._bots.get(name)
+        return state.as_dict(time.time(), self.heartbeat_timeout) if state else None
+
+    def bots(self) -> list:
+        """
+            Estado de todos los bots, ordenados por nombre.
+        """
+        now = time.time()
+        return [self._bots[name].as_dict(now, self.heartbeat_timeout) for name in sorted(self._bots)]
+
+    def online_names(self) -> list:
+        """
+            Nombres de los bots con un heartbeat más reciente que heartbeat_timeout.
+        """
+        now = time.time()
+        return sorted(name for name, state in self._bots.items()
+                      if state.last_seen is not None and now - state.last_seen < self.heartbeat_timeout)
+
+    def seen(self, name: str, frame: bool = False):
+        """
+            Registra actividad de un bot (heartbeat). frame indica que llegó una imagen suya.
+        """
+        state = self._bots.get(name)
+        if state is None:
+            return
+        now = time.time()
+        state.last_seen = now
+        if frame:
+            state.last_frame = now
+
+    async def update_temp(self, name: str, temp: int):
+        """
+            Heartbeat con temperatura. Solo se encola una escritura si la temperatura cambió.
+        """
+        self.heartbeats += 1
+        self.seen(name)
+        state = self._bots.get(name)
+        self._record(state, temp)
+        if state is not None and state.temp == temp:
+            self.skipped_writes += 1
+            return
+        if state is not None:
+            state.temp = temp
+        await self.ingest_queue.update_temp(name, temp)
+
+    async def login(self, name: str, local_ip: str, temp: int, gathering_map: str):
+        """
+            Login de un bot: lo registra si es nuevo y guarda su IP, temperatura y mapa si cambiaron.
+        """
+        state = self._bots.get(name)
+        written = True
+        if state is None:
+            await database.insert_bot(name, local_ip, 0, gathering_map)
+            await database.insert_transaction(0, name)
+            state = BotState(database.bot_ids.get(name), name, local_ip, 0, gathering_map)
+            self._bots[name] = state
+        elif (state.local_ip, state.gathering_map) != (local_ip, gathering_map):
+            # Se escribe la última temperatura encolada, así esta escritura no la pisa
+            await database.update_bot(name, local_ip, state.temp, gathering_map)
+            state.local_ip, state.gathering_map = local_ip, gathering_map
+        else:
+            written = False
+        # La temperatura va por la cola, detrás de las que ya estén encoladas para este bot;
+        # escribirla directo la dejaría pisada por una más vieja cuando la cola haga flush
+        if state.temp != temp:
+            state.temp = temp
+            await self.ingest_queue.update_temp(name, temp)
+        elif not written:
+            self.skipped_writes += 1
+        self.seen(name)
+        self._record(state, temp)
+
+    def _record(self, state: Union[BotState, None], temp: int):
+        # La temperatura se guarda en la serie de tiempo aunque no haya cambiado
+        if self.telemetry is not None and state is not None:
+            self.telemetry.record(state.id, TEMP, temp)
+            self.telemetry.record_heartbeat(state.id)
+
+    async def add(self, name: str, local_ip: str):
+        """
+            Registra un bot desde el formulario de la página principal.
+        """
+        await database.insert_bot(name, local_ip, 0, "Unknown")
+        state = self._bots.get(name)
+        if state is None:
+            self._bots[name] = BotState(database.bot_ids.get(name), name, local_ip, 0, "Unknown")
+        else:
+            state.local_ip = local_ip
+
+    async def remove(self, name: str):
+        await database.delete_bot(name)
+        self._bots.pop(name, None)
+
+    def stats(self) -> dict:
+        now = time.time()
+        online = sum(1 for s in self._bots.values()
+                     if s.last_seen is not None and now - s.last_seen < self.heartbeat_timeout)
+        return {
+            "bots": len(self._bots),
+            "online": online,
+            "heartbeats": self.heartbeats,
+            "skipped_writes": self.skipped_writes,
+        }
@@ -0,0 +1,384 @@
+import asyncio
+import csv
+import datetime
+import gzip
+import io
+import os
+from typing import NamedTuple, Union
+
+try:
+    import fcntl
+except ImportError:  # Windows: no hay bloqueo entre procesos
+    fcntl = None
+
+import database
+
+# Días que se guardan las transacciones una por una. Archivar no tiene vuelta atrás, así que la
+# tarea en segundo plano solo corre si se define TRANSACTIONS_RETENTION_DAYS (0 la desactiva).
+RETENTION_DAYS = int(os.environ.get("TRANSACTIONS_RETENTION_DAYS", 0))
+RETENTION_INTERVAL = 6 * 3600
+# Páginas que libera cada paso de incremental_vacuum (4 MB con páginas de 4 KB)
+VACUUM_PAGES = 1024
+# Pausa entre pasos para que la cola de ingesta tome la conexión de escritura
+STEP_PAUSE = 0.05
+ARCHIVE_COLUMNS = ("id", "date", "quantity", "bot_id", "bot_name", "idempotency_key")
+
+
+class ArchivedTransaction(NamedTuple):
+    id: int
+    date: str
+    quantity: int
+    bot_id: Union[int, None]
+    bot_name: Union[str, None]
+    idempotency_key: Union[str, None]
+
+
+def archive_dir(db_path: str = None) -> str:
+    """
+        Carpeta de los archivos de transacciones, junto a la base de datos.
+    """
+    db_path = db_path or database.pool.path
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), "archive")
+
+
+def archive_path(directory: str, month: str) -> str:
+    return os.path.join(directory, f"transactions-{month}.csv.gz")
+
+
+def append_archive(path: str, committed_size: int, rows) -> int:
+    """
+        Agrega rows al archivo del mes como un nuevo miembro gzip y devuelve el tamaño final.
+
+        Antes se corta el archivo en committed_size: lo que quedó después es de una ejecución
+        interrumpida cuyas filas siguen en la base de datos y se vuelven a archivar ahora.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if committed_size == 0:
+        writer.writerow(ARCHIVE_COLUMNS)
+    writer.writerows(rows)
+
+    with open(path, "a+b") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < committed_size:
+            raise RuntimeError(f"{path} tiene {f.tell()} bytes, pero se confirmaron {committed_size}")
+        f.truncate(committed_size)
+        # gzip admite miembros concatenados: el archivo completo se lee como uno solo
+        f.write(gzip.compress(buffer.getvalue().encode("utf-8")))
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+class _CommittedPart:
+    """
+        Lee un archivo solo hasta size bytes, lo confirmado en "TransactionArchives".
+    """
+
+    def __init__(self, f, size: int):
+        self.f = f
+        self.remaining = size
+
+    def read(self, n: int = -1) -> bytes:
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.f.read(n)
+        self.remaining -= len(data)
+        return data
+
+
+def iter_archive(directory: str, archives, start: str, end: str, bot_name: str = None):
+    """
+        Recorre, sin cargarlos en memoria, los ArchivedTransaction con fecha en [start, end).
+
+        archives es [(mes 'YYYY-MM', tamaño confirmado)] como lo devuelve fetch_archives.
+    """
+    for month, size in archives:
+        if month < start[:7] or month > end[:7]:
+            continue
+        with open(archive_path(directory, month), "rb") as f:
+            with gzip.GzipFile(fileobj=_CommittedPart(f, size)) as gz:
+                reader = csv.reader(io.TextIOWrapper(gz, encoding="utf-8", newline=""))
+                next(reader, None)
+                for t_id, date, quantity, bot_id, name, key in reader:
+                    if not start <= date < end or (bot_name and name != bot_name):
+                        continue
+                    yield ArchivedTransaction(int(t_id), date, int(quantity), int(bot_id) if bot_id else None,
+                                              name or None, key or None)
+
+
+async def fetch_archives():
+    """
+        Devuelve [(mes, tamaño confirmado)] de los archivos de transacciones, por mes.
+    """
+    async with database.pool.reader() as conn:
+        c = await conn.execute("""SELECT month, size FROM TransactionArchives ORDER BY month""")
+        return await c.fetchall()
+
+
+async def fetch_archived_transactions(start: str, end: str, bot_name: str = None):
+    """
+        Obtiene las transacciones archivadas con fecha en [start, end), opcionalmente de un solo bot.
+
+        Los archivos se leen en un hilo para no bloquear el event loop.
+    """
+    archives = await fetch_archives()
+    directory = archive_dir()
+    return await asyncio.to_thread(lambda: list(iter_archive(directory, archives, start, end, bot_name)))
+
+
+class RetentionJob:
+    """
+        Retención del historial de transacciones.
+
+        Las transacciones con más de `days` días se archivan en un CSV comprimido por mes (ver
+        iter_archive para consultarlas) y en "Transactions" se reemplazan por una fila por bot y
+        por día con el total (compacted = 1). Las sumas por día no cambian, así que las tablas de
+        totales y las estadísticas siguen igual.
+
+        Todo se hace de a un día por transacción de escritura, con una pausa entre días, para no
+        frenar la cola de ingesta. El espacio liberado se devuelve con incremental_vacuum en
+        pasos de VACUUM_PAGES páginas.
+
+        Las claves de idempotencia de las filas archivadas se pierden, así que un reenvío de un
+        lote de hace más de `days` días se volvería a insertar.
+    """
+
+    def __init__(self, days: int = RETENTION_DAYS, interval: float = RETENTION_INTERVAL,
+                 vacuum_pages: int = VACUUM_PAGES, step_pause: float = STEP_PAUSE):
+        self.days = days
+        self.interval = interval
+        self.vacuum_pages = vacuum_pages
+        self.step_pause = step_pause
+        self._task = None
+        self.runs = 0
+        self.days_compacted = 0
+        self.rows_archived = 0
+        self.pages_vacuumed = 0
+        self.vacuum_warning = None
+        self.last_run = None
+
+    async def start(self):
+        """
+            Arranca la tarea periódica si la retención está activa. Se llama después de database.init().
+        """
+        if self._task is None and self.days > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Error en la retención de transacciones: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self, today: datetime.date = None) -> bool:
+        """
+            Compacta los días que superaron la retención y devuelve el espacio libre.
+
+            Si otro proceso (otro worker de uvicorn o la línea de comandos) está corriendo la
+            retención sobre la misma base, no hace nada y devuelve False.
+        """
+        today = today or datetime.date.today()
+        directory = archive_dir()
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, ".lock"), "w") as lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+            await self.compact((today - datetime.timedelta(days=self.days)).isoformat())
+            await self.vacuum()
+        self.runs += 1
+        self.last_run = datetime.datetime.now().isoformat(timespec="seconds")
+        return True
+
+    async def compact(self, cutoff: str) -> int:
+        """
+            Compacta todos los días anteriores a cutoff ('YYYY-MM-DD'). Devuelve cuántos días procesó.
+        """
+        async with database.pool.reader() as conn:
+            c = await conn.execute("""SELECT substr(date, 1, 10) FROM Transactions
+                                      WHERE date < ? AND compacted = 0 GROUP BY 1 ORDER BY 1""", (cutoff, ))
+            days = [day for (day,) in await c.fetchall()]
+        for day in days:
+            await self.compact_day(day)
+            await asyncio.sleep(self.step_pause)
+        return len(days)
+
+    async def compact_day(self, day: str) -> int:
+        """
+            Archiva las transacciones de un día y las reemplaza por el total de cada bot.
+            Devuelve cuántas transacciones archivó.
+        """
+        start = day
+        end = (datetime.date.fromisoformat(day) + datetime.timedelta(days=1)).isoformat()
+        month = day[:7]
+        async with database.pool.reader() as conn:
+            c = await conn.execute("""SELECT t.id, t.date, t.quantity, t.bot_id, b.name, t.idempotency_key
+                                      FROM Transactions t LEFT JOIN Bots b ON b.id = t.bot_id
+                                      WHERE t.date >= ? AND t.date < ? AND t.compacted = 0
+                                      ORDER BY t.id""", (start, end))
+            rows = await c.fetchall()
+            c = await conn.execute("""SELECT size FROM TransactionArchives WHERE month = ?""", (month, ))
+            committed = await c.fetchone()
+        if not rows:
+            return 0
+        # Las transacciones que lleguen mientras tanto para ese día quedan para la próxima vez
+        max_id = rows[-1][0]
+
+        size = await asyncio.to_thread(append_archive, archive_path(archive_dir(), month),
+                                       committed[0] if committed else 0, rows)
+
+        async with database.pool.writer() as conn:
+            # Se suman también las filas compactadas de ejecuciones anteriores; cada total se
+            # guarda con el menor id del grupo, así el orden por id sigue siendo cronológico
+            c = await conn.execute("""SELECT min(id), sum(quantity), bot_id FROM Transactions
+                                      WHERE date >= ? AND date < ? AND id <= ? GROUP BY bot_id""",
+                                   (start, end, max_id))
+            totals = await c.fetchall()
+            await conn.execute("""DELETE FROM Transactions WHERE date >= ? AND date < ? AND id <= ?""",
+                               (start, end, max_id))
+            await conn.executemany("""INSERT INTO Transactions (id, date, quantity, bot_id, compacted)
+                                      VALUES (?,?,?,?,1)""",
+                                   [(t_id, f"{day} 00:00:00", quantity, bot_id) for t_id, quantity, bot_id in totals])
+            await conn.execute("""INSERT INTO TransactionArchives (month, rows, size) VALUES (?,?,?)
+                                  ON CONFLICT (month) DO UPDATE SET rows = rows + excluded.rows, size = excluded.size""",
+                               (month, len(rows), size))
+        self.days_compacted += 1
+        self.rows_archived += len(rows)
+        return len(rows)
+
+    async def vacuum(self, max_steps: int = None) -> int:
+        """
+            Devuelve al sistema las páginas libres de a vacuum_pages por paso. Devuelve cuántas liberó.
+
+            Si la base no tiene auto_vacuum incremental no libera nada y deja el aviso en
+            vacuum_warning (ver enable_incremental_vacuum).
+        """
+        freed = 0
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            async with database.pool.writer() as conn:
+                c = await conn.execute("PRAGMA auto_vacuum")
+                (mode,) = await c.fetchone()
+                c = await conn.execute("PRAGMA freelist_count")
+                (free,) = await c.fetchone()
+                if mode != 2:
+                    if free and self.vacuum_warning is None:
+                        self.vacuum_warning = (f"auto_vacuum incremental no está activo: {free} páginas libres "
+                                               "sin devolver; ejecutar 'python retention.py "
+                                               "enable-incremental-vacuum' con el servidor detenido")
+                        print(self.vacuum_warning)
+                    break
+                self.vacuum_warning = None
+                if not free:
+                    break
+                # executescript ejecuta el PRAGMA hasta el final; execute solo libera una página
+                await conn.executescript(f"PRAGMA incremental_vacuum({self.vacuum_pages});")
+                c = await conn.execute("PRAGMA freelist_count")
+                (remaining,) = await c.fetchone()
+            freed += free - remaining
+            if remaining >= free:
+                break
+            steps += 1
+            await asyncio.sleep(self.step_pause)
+        self.pages_vacuumed += freed
+        return freed
+
+    def stats(self) -> dict:
+        return {
+            "days": self.days,
+            "runs": self.runs,
+            "last_run": self.last_run,
+            "days_compacted": self.days_compacted,
+            "rows_archived": self.rows_archived,
+            "pages_vacuumed": self.pages_vacuumed,
+            "vacuum_warning": self.vacuum_warning,
+        }
+
+
+async def enable_incremental_vacuum():
+    """
+        Activa el auto_vacuum incremental en una base existente. Reescribe todo el archivo con
+        VACUUM, así que se debe correr con el servidor detenido.
+    """
+    async with database.pool.writer() as conn:
+        await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await conn.execute("VACUUM")
+
+
+async def status() -> dict:
+    async with database.pool.reader() as conn:
+        c = await conn.execute("PRAGMA auto_vacuum")
+        (mode,) = await c.fetchone()
+        c = await conn.execute("PRAGMA freelist_count")
+        (free,) = await c.fetchone()
+        c = await conn.execute("""SELECT compacted, count(*) FROM Transactions GROUP BY 1""")
+        counts = dict(await c.fetchall())
+        c = await conn.execute("""SELECT month, rows, size FROM TransactionArchives ORDER BY month""")
+        archives = await c.fetchall()
+    return {
+        "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}[mode],
+        "free_pages": free,
+        "raw_transactions": counts.get(0, 0),
+        "compacted_transactions": counts.get(1, 0),
+        "archives": [{"month": month, "rows": rows, "bytes": size} for month, rows, size in archives],
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import sys
+
+    parser = argparse.ArgumentParser(description="Retención del historial de transacciones.")
+    parser.add_argument("--db", default=database.DB_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compact_parser = subparsers.add_parser("compact", help="Archiva y compacta las transacciones antiguas")
+    compact_parser.add_argument("--days", type=int, default=RETENTION_DAYS or None, required=not RETENTION_DAYS)
+    subparsers.add_parser("vacuum", help="Devuelve el espacio libre al sistema")
+    subparsers.add_parser("enable-incremental-vacuum",
+                          help="Activa el auto_vacuum incremental (reescribe la base, con el servidor detenido)")
+    subparsers.add_parser("status", help="Muestra el estado de la retención")
+    query_parser = subparsers.add_parser("query", help="Escribe en CSV las transacciones archivadas")
+    query_parser.add_argument("start", help="Fecha inicial, incluida (YYYY-MM-DD)")
+    query_parser.add_argument("end", help="Fecha final, excluida (YYYY-MM-DD)")
+    query_parser.add_argument("--bot")
+    args = parser.parse_args()
+
+    async def main():
+        await database.init(args.db)
+        try:
+            if args.command == "compact":
+                job = RetentionJob(days=args.days, step_pause=0)
+                await job.run_once()
+                print(json.dumps(job.stats()))
+            elif args.command == "vacuum":
+                print(f"{await RetentionJob(step_pause=0).vacuum()} páginas liberadas")
+            elif args.command == "enable-incremental-vacuum":
+                await enable_incremental_vacuum()
+            elif args.command == "status":
+                print(json.dumps(await status(), indent=2))
+            elif args.command == "query":
+                writer = csv.writer(sys.stdout)
+                writer.writerow(ARCHIVE_COLUMNS)
+                for transaction in iter_archive(archive_dir(args.db), await fetch_archives(),
+                                                args.start, args.end, args.bot):
+                    writer.writerow(transaction)
+        finally:
+            await database.close()
+
+    asyncio.run(main())
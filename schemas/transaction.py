@@ -0,0 +1,20 @@
+import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+# Transacciones aceptadas por petición en /add_transactions
+MAX_BATCH_TRANSACTIONS = 5000
+
+
+class TransactionSchema(BaseModel):
+    bot_name: str
+    quantity: int
+    # Momento en que ocurrió la transacción; si falta se usa la hora de llegada
+    date: Optional[datetime.datetime] = None
+    # Identificador único elegido por el cliente para que los reintentos no se dupliquen
+    idempotency_key: Optional[str] = Field(default=None, max_length=128)
+
+
+class TransactionBatchSchema(BaseModel):
+    transactions: List[TransactionSchema] = Field(max_length=MAX_BATCH_TRANSACTIONS)
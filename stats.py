@@ -0,0 +1,217 @@
+import asyncio
+import calendar
+import datetime
+import time
+from collections import OrderedDict
+from typing import List, NamedTuple, Tuple, Union
+
+import database
+
+# Pesos chilenos por millón de silver
+CLP_PER_MILLION = 450
+# Segundos que vive una entrada de la caché aunque no se invalide
+STATS_TTL = 30
+STATS_CACHE_SIZE = 256
+# Clave de generación que se incrementa cuando se invalida toda la caché
+ALL_BOTS = object()
+
+
+class MonthTotal(NamedTuple):
+    month: str      # 'YYYY-MM'
+    name: str       # Nombre del mes, p. ej. 'January'
+    quantity: int
+
+
+class DayTotal(NamedTuple):
+    date: str       # 'YYYY-MM-DD'
+    day: int
+    quantity: int
+
+
+class BotStats(NamedTuple):
+    monthly: List[MonthTotal]
+    daily: List[DayTotal]
+    avg_year: float
+    avg_this_month: float
+    clp_avg_year: int
+
+    @property
+    def total_this_year(self) -> dict:
+        """
+            Totales del año como {nombre del mes: total}, en el orden del calendario.
+        """
+        return {m.name: m.quantity for m in self.monthly}
+
+
+# Estadísticas de un período futuro
+EMPTY_STATS = BotStats([], [], 0, 0, 0)
+
+
+def monthly_summary(rows) -> Tuple[List[MonthTotal], float]:
+    """
+        Convierte las filas [('YYYY-MM', total)] en MonthTotal y calcula el promedio mensual
+        (sobre los meses con datos, igual que calculate_total_per_month).
+    """
+    monthly = [MonthTotal(month, calendar.month_name[int(month[5:7])], quantity)
+               for month, quantity in sorted(rows)]
+    if not monthly:
+        return monthly, 0
+    return monthly, round(sum(m.quantity for m in monthly) / len(monthly), 1)
+
+
+def daily_summary(rows, today: datetime.date) -> Tuple[List[DayTotal], float]:
+    """
+        Convierte las filas [('YYYY-MM-DD', total)] del mes en DayTotal y calcula el promedio
+        diario desde el primer día con datos hasta hoy.
+    """
+    daily = [DayTotal(day, int(day[8:10]), quantity) for day, quantity in sorted(rows)]
+    if not daily:
+        return daily, 0
+    days = today.day - daily[0].day
+    if days <= 0:
+        return daily, 0
+    return daily, sum(d.quantity for d in daily) / days
+
+
+async def bot_stats(bot_name: str = None, today: datetime.date = None) -> BotStats:
+    """
+        Calcula las estadísticas de la página de detalles a partir de las tablas de totales.
+
+        Si bot_name es None se calculan las de toda la granja. Las dos consultas se hacen en
+        paralelo (cada una usa su propia conexión de lectura).
+    """
+    today = today or datetime.date.today()
+    month_rows, day_rows = await asyncio.gather(
+        database.fetch_monthly_totals(today.year, bot_name),
+        database.fetch_daily_totals(today.year, today.month, bot_name),
+    )
+    monthly, avg_year = monthly_summary(month_rows)
+    daily, avg_this_month = daily_summary(day_rows, today)
+    return BotStats(monthly, daily, avg_year, avg_this_month, round(avg_year / 1000000 * CLP_PER_MILLION))
+
+
+class StatsCache:
+    """
+        Caché LRU con TTL de las estadísticas, con clave (bot o None para la granja, año, mes).
+
+        Las entradas de un bot, y las de la granja, se invalidan cuando se le insertan transacciones
+        (ver database.add_transaction_listener); el TTL solo es una red de seguridad. Las peticiones
+        simultáneas de una clave que no está en la caché comparten un único cálculo.
+    """
+
+    def __init__(self, ttl: float = STATS_TTL, max_entries: int = STATS_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._pending = dict()
+        self._generations = dict()
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    async def get(self, key: tuple, compute):
+        """
+            Devuelve el valor de key, calculándolo con compute() (una corrutina) si hace falta.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+
+        self.misses += 1
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._compute(key, compute))
+            self._pending[key] = task
+        else:
+            self.shared += 1
+        # Si quien pidió el cálculo se cancela, los demás siguen esperándolo
+        return await asyncio.shield(task)
+
+    async def _compute(self, key: tuple, compute):
+        generation = self._generation(key[0])
+        task = asyncio.current_task()
+        try:
+            value = await compute()
+        finally:
+            if self._pending.get(key) is task:
+                del self._pending[key]
+        # Si se invalidó mientras se calculaba, el valor puede estar desactualizado: no se guarda
+        if generation == self._generation(key[0]):
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def _generation(self, bot_name):
+        return self._generations.get(bot_name, 0), self._generations.get(ALL_BOTS, 0)
+
+    def invalidate(self, bot_names=None):
+        """
+            Descarta las entradas de los bots indicados y las de la granja; con None, todas.
+        """
+        self.invalidations += 1
+        if bot_names is None:
+            self._bump(ALL_BOTS)
+            self._entries.clear()
+            self._pending.clear()
+            return
+        affected = set(bot_names) | {None}
+        for bot_name in affected:
+            self._bump(bot_name)
+        for key in [k for k in self._entries if k[0] in affected]:
+            del self._entries[key]
+        for key in [k for k in self._pending if k[0] in affected]:
+            del self._pending[key]
+
+    def _bump(self, bot_name):
+        self._generations[bot_name] = self._generations.get(bot_name, 0) + 1
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "hit_rate": round(self.hits / requests, 3) if requests else 0.0,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+        }
+
+
+cache = StatsCache()
+database.add_transaction_listener(cache.invalidate)
+
+
+def reference_day(year: int = None, month: int = None) -> Union[datetime.date, None]:
+    """
+        Día hasta el que se calculan las estadísticas de un mes: hoy para el mes actual, el
+        último día del mes para los meses pasados y None para los meses futuros (sin datos).
+    """
+    today = datetime.date.today()
+    year = year or today.year
+    month = month or (today.month if year == today.year else 12)
+    if (year, month) > (today.year, today.month):
+        return None
+    if (year, month) == (today.year, today.month):
+        return today
+    return datetime.date(year, month, calendar.monthrange(year, month)[1])
+
+
+async def cached_bot_stats(bot_name: str = None, year: int = None, month: int = None) -> BotStats:
+    """
+        bot_stats de un mes (por defecto el actual), a través de la caché.
+    """
+    day = reference_day(year, month)
+    if day is None:
+        return EMPTY_STATS
+    return await cache.get((bot_name, day.year, day.month), lambda: bot_stats(bot_name, day))
@@ -1,139 +1,433 @@
-import sqlite3
 import base64
+import struct
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
 import cv2
 import numpy as np
 import imutils
-from typing import Union, Any, Mapping
-from fastapi import UploadFile, File, BackgroundTasks
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Union, Any, Mapping, Tuple
+from fastapi import BackgroundTasks
+# Route handlers receive Starlette's UploadFile (fastapi.UploadFile is a subclass used for validation)
+from starlette.datastructures import UploadFile
 from starlette.responses import StreamingResponse
 import asyncio
 
-SQLLITE_CONN_STR = "file:framestreamerdb1?mode=memory&cache=shared"
+from frame_cache import TranscodeCache
+from frame_store import Frame, FrameStore, MemoryFrameStore
+from mosaic import MAX_MOSAICS, MosaicBuilder, normalize_layout
+import metrics
+
+VIEWER_WIDTH = 680
+JPEG_QUALITY = 95
+IMAGE_WORKERS = 4
+# Mean absolute difference (0-255) between frame signatures below which an upload is a duplicate
+CHANGE_THRESHOLD = 2.0
+SIGNATURE_SIZE = (32, 18)
+
+# Binary grid stream record: u16 id length + id, then u32 sequence + u32 JPEG length + JPEG
+FRAME_RECORD_HEADER = struct.Struct("!H")
+FRAME_RECORD_BODY = struct.Struct("!II")
+
+# Prometheus metrics (see metrics.py), switchable with METRICS_DISABLED=streams,transcode
+STREAM_METRICS = metrics.registry.subsystem("streams")
+FRAMES_RECEIVED = STREAM_METRICS.counter("frames_received_total", "Frames uploaded per stream", ("stream",))
+FRAME_BYTES = STREAM_METRICS.counter("frame_bytes_received_total", "Bytes uploaded per stream", ("stream",))
+FRAMES_UNCHANGED = STREAM_METRICS.counter("frames_unchanged_total",
+                                          "Uploads dropped as duplicates of the previous frame", ("stream",))
+# Uploads to streams that are not known (see FrameStreamer's known_stream) share this label,
+# so clients cannot create new series at will
+UNKNOWN_STREAM = "unregistered"
+# Viewers are always counted (cheap and must stay balanced); the switch only hides them
+VIEWERS = STREAM_METRICS.gauge("stream_viewers", "Open viewer connections per endpoint", ("endpoint",))
+TRANSCODE_METRICS = metrics.registry.subsystem("transcode")
+TRANSCODE_STAGES = TRANSCODE_METRICS.histogram("transcode_stage_duration_seconds",
+                                               "Time spent in each transcode stage", ("stage",))
+
+
+def decode_image(data: bytes) -> Any:
+    """Decode an encoded image (JPEG bytes) to an OpenCV image
+
+    Args:
+        data (bytes): Encoded image
+
+    Returns:
+        Any: Image decoded from OpenCV
+    """
+    if data is None:
+        return None
+    nparr = np.frombuffer(data, np.uint8)
+    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    return img
+
+
+def downscale_image(data: bytes, max_width: int, quality: int) -> bytes:
+    """Shrink an encoded image to `max_width` if it is wider, otherwise return it untouched
+
+    Args:
+        data (bytes): Encoded image
+        max_width (int): Maximum width (aspect ratio is kept)
+        quality (int): JPEG quality used when the image is re-encoded
+
+    Returns:
+        bytes: Encoded image no wider than `max_width` (the original if it cannot be decoded)
+    """
+    frame = decode_image(data)
+    if frame is None or frame.shape[1] <= max_width:
+        return data
+    frame = imutils.resize(frame, width=max_width)
+    flag, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return encoded.tobytes() if flag else data
+
+
+def frame_signature(data: bytes) -> Union[np.ndarray, None]:
+    """Tiny grayscale copy of an encoded image, used to detect duplicate frames
+
+    The JPEG is decoded at 1/8 scale, which is much cheaper than a full decode.
+    Args:
+        data (bytes): Encoded image
+
+    Returns:
+        Union[np.ndarray, None]: SIGNATURE_SIZE grayscale image or None if it could not be decoded
+    """
+    small = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if small is None:
+        return None
+    return cv2.resize(small, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA)
+
+
+def pack_frame_record(stream_id: str, seq: int, data: bytes) -> bytes:
+    """Pack a frame for the binary grid stream
+
+    Layout (big-endian): u16 id length, id (UTF-8), u32 sequence number, u32 JPEG length, JPEG bytes.
+
+    Args:
+        stream_id (str): ID of the stream
+        seq (int): Sequence number of the frame
+        data (bytes): JPEG bytes
+
+    Returns:
+        bytes: Packed record
+    """
+    name = stream_id.encode("utf-8")
+    return FRAME_RECORD_HEADER.pack(len(name)) + name + FRAME_RECORD_BODY.pack(seq & 0xFFFFFFFF, len(data)) + data
+
+
+def transcode_image(data: bytes, width: int, quality: int) -> Tuple[Union[bytes, None], Tuple[float, float, float]]:
+    """Resize an encoded image to `width` and re-encode it as JPEG
+
+    Args:
+        data (bytes): Encoded image
+        width (int): Target width (aspect ratio is kept)
+        quality (int): JPEG quality
+
+    Returns:
+        Tuple: Transcoded JPEG (or None if the image could not be processed) and the
+        (decode, resize, encode) timings in seconds
+    """
+    start = time.perf_counter()
+    frame = decode_image(data)
+    decoded = time.perf_counter()
+    if frame is None:
+        return None, (decoded - start, 0.0, 0.0)
+    frame = imutils.resize(frame, width=width)
+    resized = time.perf_counter()
+    flag, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    encoded_at = time.perf_counter()
+    return (encoded.tobytes() if flag else None), (decoded - start, resized - decoded, encoded_at - resized)
 
 
 class FrameStreamer:
     """The FrameStreamer class allows you to send frames and visualize them as a stream"""
 
-    def __init__(self):
-        self.conn = sqlite3.connect(SQLLITE_CONN_STR, uri=True)
-        self._initialize_db()
-
-    def _initialize_db(self):
-        with self.conn:
-            self.conn.execute('''CREATE TABLE IF NOT EXISTS images (
-                                    id TEXT PRIMARY KEY,
-                                    image TEXT
-                                )''')
+    def __init__(self, store: Union[FrameStore, None] = None, workers: int = IMAGE_WORKERS,
+                 use_processes: bool = False, ingest_max_width: Union[int, None] = None,
+                 change_threshold: float = CHANGE_THRESHOLD, known_stream=None):
+        """
+        Args:
+            store (Union[FrameStore, None], optional): Frame store backend. Defaults to an in-process MemoryFrameStore.
+            workers (int, optional): Size of the image worker pool. Defaults to IMAGE_WORKERS.
+            use_processes (bool, optional): Use a process pool instead of threads. Defaults to False.
+            ingest_max_width (Union[int, None], optional): Downscale uploaded frames wider than this. Defaults to None (keep as-is).
+            change_threshold (float, optional): Uploads that differ less than this from the previous frame
+                (mean absolute difference of their signatures, 0-255) are dropped. 0 disables the check.
+                Defaults to CHANGE_THRESHOLD.
+            known_stream (Callable[[str], bool], optional): Tells whether a stream belongs to a registered bot;
+                only those get their own label in the per-stream metrics. Defaults to None (all streams do).
+        """
+        self.store = store if store is not None else MemoryFrameStore()
+        self.ingest_max_width = ingest_max_width
+        self.change_threshold = change_threshold
+        self.known_stream = known_stream
+        self.frames_received = 0
+        self.frames_unchanged = 0
+        self._signatures = dict()
+        self._last_upload = dict()
+        self._last_change = dict()
+        self.transcode_cache = TranscodeCache()
+        # Image work (decode/resize/encode) never runs on the event loop
+        pool_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self.executor = pool_class(max_workers=workers)
+        self.stage_timings = {stage: TRANSCODE_STAGES.labels(stage) for stage in ("decode", "resize", "encode")}
+        self._transcoding = dict()
+        self._mosaics = OrderedDict()
+        # One event per stream with waiting viewers, plus one for "any stream changed".
+        # Events are replaced after being set, so each one wakes the viewers waiting at that moment.
+        self._stream_events = dict()
+        self._any_event = asyncio.Event()
+
+    async def send_frame(self, stream_id: str, frame: Union[str, UploadFile, bytes],
+                         max_width: Union[int, None] = None) -> bool:
+        """Send a frame to be streamed.
 
-    def _get_image(self, img_id: str) -> Union[str, None]:
-        """Get an image from the SQLite DB.
+        Frames that are nearly identical to the previous one of the stream are dropped:
+        they do not bump the sequence number, so viewers receive nothing new.
 
         Args:
-            img_id (str): ID (primary key) of the image to be retrieved in the DB
+            stream_id (str): ID (primary key) of the frame
+            frame (Union[str, UploadFile, bytes]): Frame (image) to be streamed. Strings are base64 encoded images.
+            max_width (Union[int, None], optional): Downscale the frame if it is wider than this.
+                Defaults to the streamer's ingest_max_width.
 
         Returns:
-            Union[str, None]: Image (in base64) or None if not found
+            bool: True if the frame was stored, False if it was dropped as unchanged
         """
-        try:
-            with sqlite3.connect(SQLLITE_CONN_STR, uri=True) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT image FROM images WHERE id = ?", (img_id,))
-                row = cursor.fetchone()
-                return row[0] if row else None
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return None
-        except Exception as e:
-            print(f"Unexpected error: {e}")
-            return None
-
-    async def _store_image_str(self, img_id: str, img_str_b64: str) -> None:
-        """Store an image string (in base64) to the DB.
+        if isinstance(frame, str):
+            data = base64.b64decode(frame)
+        elif isinstance(frame, UploadFile):
+            data = await frame.read()
+        elif isinstance(frame, bytes):
+            data = frame
+        else:
+            return False
+
+        now = time.time()
+        self.frames_received += 1
+        self._last_upload[stream_id] = now
+        label = self._metric_label(stream_id)
+        if STREAM_METRICS.enabled:
+            FRAMES_RECEIVED.labels(label).inc()
+            FRAME_BYTES.labels(label).inc(len(data))
+        signature = None
+        if self.change_threshold > 0:
+            signature = await self.run_in_pool(frame_signature, data)
+            if not self._frame_changed(stream_id, signature):
+                self.frames_unchanged += 1
+                if STREAM_METRICS.enabled:
+                    FRAMES_UNCHANGED.labels(label).inc()
+                return False
+
+        max_width = max_width or self.ingest_max_width
+        if max_width:
+            data = await self.run_in_pool(downscale_image, data, max_width, JPEG_QUALITY)
+        self.store.put(stream_id, data)
+        # Only a stored frame becomes the reference: if downscaling or storing failed,
+        # a retry of the same frame must not be dropped as unchanged
+        if signature is not None:
+            self._signatures[stream_id] = signature
+        self._last_change[stream_id] = now
+        self._publish(stream_id)
+        return True
+
+    def _metric_label(self, stream_id: str) -> str:
+        if self.known_stream is None or self.known_stream(stream_id):
+            return stream_id
+        return UNKNOWN_STREAM
+
+    def forget_stream(self, stream_id: str) -> None:
+        """Drop the frames, per-stream state, cached renditions and metric series of a stream whose bot was deleted.
 
         Args:
-            img_id (str): ID (primary key) of the image.
-            img_str_b64 (str): Image string (in base64)
+            stream_id (str): ID of the stream
         """
-        try:
-            with sqlite3.connect(SQLLITE_CONN_STR, uri=True) as conn:
-                cursor = conn.cursor()
-                cursor.execute("INSERT OR REPLACE INTO images (id, image) VALUES (?, ?)", (img_id, img_str_b64))
-                conn.commit()
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-        except Exception as e:
-            print(f"Unexpected error: {e}")
-
-    async def _image_file_to_base64(self, file: UploadFile = File(...)) -> str:
-        """Convert a loaded image to Base64
+        self._signatures.pop(stream_id, None)
+        self._last_upload.pop(stream_id, None)
+        self._last_change.pop(stream_id, None)
+        self.store.discard(stream_id)
+        self.transcode_cache.discard_stream(stream_id)
+        # Viewers still waiting for the stream wake up and find it empty
+        event = self._stream_events.pop(stream_id, None)
+        if event is not None:
+            event.set()
+        for family in (FRAMES_RECEIVED, FRAME_BYTES, FRAMES_UNCHANGED):
+            family.remove(stream_id)
+
+    def _frame_changed(self, stream_id: str, signature: Union[np.ndarray, None]) -> bool:
+        if signature is None:
+            return True
+        previous = self._signatures.get(stream_id)
+        return previous is None or previous.shape != signature.shape \
+            or float(cv2.absdiff(previous, signature).mean()) >= self.change_threshold
+
+    def stream_status(self, stuck_after: float) -> dict:
+        """Upload activity of every stream
 
         Args:
-            file (UploadFile, optional): Image file to be converted.
+            stuck_after (float): Seconds without a changed frame after which a stream that keeps
+                uploading is reported as stuck
 
         Returns:
-            str: Image converted (in Base64)
+            dict: stream_id -> {last_upload, last_change, unchanged_for, stuck}
         """
-        image_file = await file.read()
-        return base64.b64encode(image_file).decode("utf-8")
+        now = time.time()
+        status = dict()
+        for stream_id, last_upload in self._last_upload.items():
+            last_change = self._last_change.get(stream_id, last_upload)
+            unchanged_for = now - last_change
+            status[stream_id] = {
+                "last_upload": last_upload,
+                "last_change": last_change,
+                "unchanged_for": round(unchanged_for, 1),
+                "stuck": unchanged_for >= stuck_after and now - last_upload < stuck_after,
+            }
+        return status
+
+    def _publish(self, stream_id: str) -> None:
+        """Wake up the viewers waiting for a new frame of a stream."""
+        event = self._stream_events.pop(stream_id, None)
+        if event is not None:
+            event.set()
+        self._any_event.set()
+        self._any_event = asyncio.Event()
+
+    async def wait_frame(self, stream_id: str, last_seq: int = 0) -> Frame:
+        """Wait until a stream has a frame newer than `last_seq` and return the latest one.
+
+        Viewers that fall behind skip the intermediate frames and get the newest.
 
-    async def send_frame(self, stream_id: str, frame: Union[str, UploadFile, bytes]) -> None:
-        """Send a frame to be streamed.
+        Args:
+            stream_id (str): ID of the stream
+            last_seq (int, optional): Sequence number of the last frame the viewer got. Defaults to 0.
+
+        Returns:
+            Frame: Latest frame of the stream
+        """
+        while True:
+            frame = self.store.get(stream_id)
+            if frame is not None and frame.seq != last_seq:
+                return frame
+            event = self._stream_events.get(stream_id)
+            if event is None:
+                event = self._stream_events[stream_id] = asyncio.Event()
+            await self._wait_event(event)
+
+    async def wait_any_frame(self) -> None:
+        """Wait until any stream receives a new frame.
+
+        With a store shared between processes it may also return after the store's poll
+        interval without a new frame, since uploads to other processes set no local event.
+        """
+        await self._wait_event(self._any_event)
+
+    async def _wait_event(self, event: asyncio.Event) -> None:
+        if self.store.poll_interval is None:
+            await event.wait()
+            return
+        try:
+            await asyncio.wait_for(event.wait(), self.store.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run_in_pool(self, func, *args):
+        """Run a CPU bound function (image work) in the worker pool
+
+        Every function handed to the pool (downscale_image, frame_signature, transcode_image,
+        mosaic.render_tile, ...) must stay a module level function, so a process pool can pickle it.
 
         Args:
-            stream_id (str): ID (primary key) of the frame
-            frame (Union[str, UploadFile, bytes]): Frame (image) to be streamed.
+            func: Function to run
+            *args: Arguments of the function
+
+        Returns:
+            Any: Result of the function
         """
-        if isinstance(frame, str):
-            await self._store_image_str(stream_id, frame)
-        elif isinstance(frame, UploadFile):
-            img_str = await self._image_file_to_base64(frame)
-            await self._store_image_str(stream_id, img_str)
-        elif isinstance(frame, bytes):
-            img_str = base64.b64encode(frame).decode("utf-8")
-            await self._store_image_str(stream_id, img_str)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
 
-    def _readb64(self, encoded_img: str) -> Any:
-        """Decode an image (in base64) to an OpenCV image
+    async def get_transcoded(self, stream_id: str, frame: Frame, width: int = VIEWER_WIDTH,
+                             quality: int = JPEG_QUALITY) -> Union[bytes, None]:
+        """Get a stored frame resized to `width`, transcoding it only once for all viewers
+
+        The transcode runs in the worker pool. Viewers asking for a frame that is already
+        being transcoded wait for that job instead of starting another one.
 
         Args:
-            encoded_img (str): Image (in base64)
+            stream_id (str): ID of the stream
+            frame (Frame): Source frame from the frame store
+            width (int, optional): Target width. Defaults to VIEWER_WIDTH.
+            quality (int, optional): JPEG quality. Defaults to JPEG_QUALITY.
 
         Returns:
-            Any: Image decoded from OpenCV
+            Union[bytes, None]: Transcoded JPEG or None if the frame could not be processed
         """
-        if encoded_img is None:
-            return None
-        nparr = np.frombuffer(base64.b64decode(encoded_img), np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        return img
+        data = self.transcode_cache.get(stream_id, frame.seq, width, quality)
+        if data is not None:
+            return data
+
+        key = (stream_id, frame.seq, width, quality)
+        job = self._transcoding.get(key)
+        if job is None:
+            job = self._transcoding[key] = asyncio.ensure_future(self._transcode(key, frame.data))
+        return await asyncio.shield(job)
+
+    async def _transcode(self, key, data: bytes) -> Union[bytes, None]:
+        stream_id, seq, width, quality = key
+        try:
+            encoded, timings = await self.run_in_pool(transcode_image, data, width, quality)
+        finally:
+            del self._transcoding[key]
+        if TRANSCODE_METRICS.enabled:
+            for stage, elapsed in zip(("decode", "resize", "encode"), timings):
+                self.stage_timings[stage].observe(elapsed)
+        if encoded is not None:
+            self.transcode_cache.put(stream_id, seq, width, quality, encoded)
+        return encoded
+
+    @staticmethod
+    @contextmanager
+    def _viewer(endpoint: str):
+        """Count an open viewer connection while the stream generator runs."""
+        gauge = VIEWERS.labels(endpoint)
+        gauge.inc()
+        try:
+            yield
+        finally:
+            gauge.dec()
+
+    def close(self) -> None:
+        """Stop the worker pool and close the frame store."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.store.close()
+
+    async def _start_stream(self, img_id: str, freq: int = 30):
+        """Send every new frame of a stream in HTML image/jpeg format
 
-    def _start_stream(self, img_id: str, freq: int = 30):
-        """Continuous loop to stream the frame from SQLite to HTML image/jpeg format
+        Nothing is sent while the stream does not change.
 
         Args:
-            img_id (str): ID (primary key) of the image in the DB
-            freq (int, optional): Loop frequency. Defaults to 30.
+            img_id (str): ID of the stream
+            freq (int, optional): Maximum frames per second. Defaults to 30.
 
         Yields:
             bytes: HTML containing the bytes to plot the stream
         """
-        sleep_duration = 1.0 / freq
-
-        while True:
-            time.sleep(sleep_duration)
-            try:
-                frame = self._readb64(self._get_image(img_id))
-                if frame is None:
-                    continue
-                frame = imutils.resize(frame, width=680)
-                (flag, encodedImage) = cv2.imencode(".jpg", frame)
-                if not flag:
+        with self._viewer("video_feed"):
+            min_interval = 1.0 / freq
+            last_seq = 0
+
+            while True:
+                stored = await self.wait_frame(img_id, last_seq)
+                last_seq = stored.seq
+                sent_at = time.monotonic()
+                try:
+                    encoded = await self.get_transcoded(img_id, stored)
+                    if encoded is None:
+                        continue
+                    yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + encoded + b'\r\n')
+                except Exception as e:
+                    print(f"Error during streaming: {e}")
                     continue
-                yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encodedImage) + b'\r\n')
-            except Exception as e:
-                print(f"Error during streaming: {e}")
-                continue
+                await asyncio.sleep(max(0.0, min_interval - (time.monotonic() - sent_at)))
 
     def get_stream(self, stream_id: str, freq: int = 30, status_code: int = 206,
                    headers: Union[Mapping[str, str], None] = None,
@@ -142,7 +436,7 @@ class FrameStreamer:
 
         Args:
             stream_id (str): ID (primary key) of the stream to be retrieved
-            freq (int, optional): Frequency of the continuous loop retrieval (in Hz). Defaults to 30.
+            freq (int, optional): Maximum frames per second sent to the viewer. Defaults to 30.
             status_code (int, optional): HTTP response status code. Defaults to 206.
             headers (Union[Mapping[str, str], None], optional): HTTP headers. Defaults to None.
             background (Union[BackgroundTasks, None], optional): FastAPI background. Defaults to None.
@@ -156,37 +450,161 @@ class FrameStreamer:
                                  headers=headers,
                                  background=background)
 
-    async def base64_mix_generator(self, bots_names, fps=15):
-        sleep_duration = 1.0 / fps
-        while True:
-            await asyncio.sleep(sleep_duration)
-            mix = ''
-            for bot in bots_names:
-                stream_id = bot['name']
-                try:
-                    # Obtiene la imagen en base64
-                    base64_frame = self._get_image(stream_id)
+    def get_mosaic(self, columns: int, tile_width: int) -> MosaicBuilder:
+        """Get the shared mosaic builder for a layout (created on first use, at most MAX_MOSAICS are kept)
 
-                    # Decodifica la imagen
-                    frame = self._readb64(base64_frame)
-                except (ValueError, cv2.error) as e:
-                    print(f"Error procesando la imagen de {stream_id}: {e}")
-                    continue
+        Args:
+            columns (int): Tiles per row
+            tile_width (int): Width of each tile
 
-                if frame is None:
-                    continue
+        Returns:
+            MosaicBuilder: Builder for the normalized layout
+        """
+        key = normalize_layout(columns, tile_width)
+        mosaic = self._mosaics.get(key)
+        if mosaic is None:
+            mosaic = self._mosaics[key] = MosaicBuilder(self, *key)
+            while len(self._mosaics) > MAX_MOSAICS:
+                self._mosaics.popitem(last=False)
+        else:
+            self._mosaics.move_to_end(key)
+        return mosaic
+
+    async def _start_mosaic_stream(self, stream_ids, columns: int, tile_width: int, freq: int):
+        """Send the mosaic of all the streams in HTML image/jpeg format every time a tile changes
 
-                # Redimensiona y codifica la imagen
-                output_frame = imutils.resize(frame, width=680)
-                if output_frame is None:
-                    continue
+        Args:
+            stream_ids (Callable[[], list]): Returns the streams to show, in tile order
+            columns (int): Tiles per row
+            tile_width (int): Width of each tile
+            freq (int): Maximum frames per second
 
-                flag, encodedImage = cv2.imencode(".jpg", output_frame)
-                if not flag:
-                    continue
+        Yields:
+            bytes: HTML containing the bytes to plot the mosaic
+        """
+        with self._viewer("mosaic_feed"):
+            mosaic = self.get_mosaic(columns, tile_width)
+            min_interval = 1.0 / freq
+            last_seq = None
+            while True:
+                started = time.monotonic()
+                frame = await mosaic.update(stream_ids())
+                if frame is not None and frame.seq != last_seq:
+                    last_seq = frame.seq
+                    yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + frame.data + b'\r\n')
+                    await asyncio.sleep(max(0.0, min_interval - (time.monotonic() - started)))
+                else:
+                    # The layout can change without new frames (bots added or removed)
+                    try:
+                        await asyncio.wait_for(self.wait_any_frame(), 1.0)
+                    except asyncio.TimeoutError:
+                        pass
+
+    def get_mosaic_stream(self, stream_ids, columns: int, tile_width: int, freq: int = 5,
+                          status_code: int = 206) -> StreamingResponse:
+        """Get a single MJPEG stream with a tiled mosaic of several streams
+
+        Args:
+            stream_ids (Callable[[], list]): Returns the streams to show, in tile order
+            columns (int): Tiles per row
+            tile_width (int): Width of each tile
+            freq (int, optional): Maximum frames per second. Defaults to 5.
+            status_code (int, optional): HTTP response status code. Defaults to 206.
+
+        Returns:
+            StreamingResponse: FastAPI StreamingResponse
+        """
+        return StreamingResponse(self._start_mosaic_stream(stream_ids, columns, tile_width, freq),
+                                 media_type="multipart/x-mixed-replace;boundary=frame",
+                                 status_code=status_code)
+
+    def changed_frames(self, stream_ids, last_seqs: dict) -> list:
+        """Get the streams whose latest frame is not the one in `last_seqs`
+
+        Args:
+            stream_ids: IDs of the streams to check
+            last_seqs (dict): stream_id -> sequence number of the last frame sent to the viewer
+
+        Returns:
+            list: [(stream_id, Frame)] with the changed streams
+        """
+        changed = list()
+        for stream_id in stream_ids:
+            stored = self.store.get(stream_id)
+            if stored is not None and last_seqs.get(stream_id) != stored.seq:
+                changed.append((stream_id, stored))
+        return changed
+
+    async def transcode_batch(self, changed: list, last_seqs: dict, width: int = VIEWER_WIDTH) -> list:
+        """Transcode several frames concurrently in the worker pool and mark them as sent
 
-                mix += f"{stream_id}:{base64_frame} "
+        Args:
+            changed (list): [(stream_id, Frame)] as returned by changed_frames
+            last_seqs (dict): Viewer state updated with the sequence numbers of `changed`
+            width (int, optional): Width of the transcoded frames. Defaults to VIEWER_WIDTH.
+
+        Returns:
+            list: [(stream_id, seq, jpeg_bytes)] for the frames that could be transcoded
+        """
+        # Redimensiona y codifica las imágenes en el pool, una sola vez para todos los clientes
+        results = await asyncio.gather(*(self.get_transcoded(stream_id, stored, width)
+                                         for stream_id, stored in changed),
+                                       return_exceptions=True)
+        batch = list()
+        for (stream_id, stored), encoded in zip(changed, results):
+            last_seqs[stream_id] = stored.seq
+            if isinstance(encoded, Exception):
+                print(f"Error procesando la imagen de {stream_id}: {encoded}")
+                continue
+            if encoded is None:
+                continue
+            batch.append((stream_id, stored.seq, encoded))
+        return batch
+
+    async def _changed_frames(self, stream_ids, fps: int, width: int = VIEWER_WIDTH):
+        """Yield, at most `fps` times per second, the streams that got a new frame since the last batch.
+
+        Nothing is yielded while none of the streams change.
+
+        Args:
+            stream_ids: IDs of the streams to watch
+            fps (int): Maximum batches per second
+            width (int, optional): Width of the transcoded frames. Defaults to VIEWER_WIDTH.
+
+        Yields:
+            list: [(stream_id, seq, jpeg_bytes)] with the changed streams
+        """
+        min_interval = 1.0 / fps
+        last_seqs = dict()
+        while True:
+            sent_at = time.monotonic()
+            changed = self.changed_frames(stream_ids, last_seqs)
+            if not changed:
+                await self.wait_any_frame()
+                continue
+
+            batch = await self.transcode_batch(changed, last_seqs, width)
+            if batch:
+                yield batch
+            await asyncio.sleep(max(0.0, min_interval - (time.monotonic() - sent_at)))
 
-            # Elimina el último espacio ' '
-            mix = mix.rstrip(' ')
-            yield mix
+    async def base64_mix_generator(self, bots_names, fps=15):
+        """Stream the frames of several bots as "name:base64 name:base64 ..." chunks.
+
+        Legacy text protocol, kept for old clients; see binary_mix_generator.
+        Each chunk only contains the streams that got a new frame since the previous one.
+        """
+        with self._viewer("base64_stream"):
+            async for batch in self._changed_frames([bot['name'] for bot in bots_names], fps):
+                yield ' '.join(f"{stream_id}:{base64.b64encode(encoded).decode('utf-8')}"
+                               for stream_id, _, encoded in batch)
+
+    async def binary_mix_generator(self, bots_names, fps=15):
+        """Stream the frames of several bots as length-prefixed binary records.
+
+        See pack_frame_record for the record layout. Each chunk only contains the streams
+        that got a new frame since the previous one.
+        """
+        with self._viewer("grid_stream"):
+            async for batch in self._changed_frames([bot['name'] for bot in bots_names], fps):
+                yield b''.join(pack_frame_record(stream_id, seq, encoded) for stream_id, seq, encoded in batch)
@@ -0,0 +1,216 @@
+import asyncio
+import time
+from array import array
+from typing import Union
+
+import database
+
+TEMP = 1
+HEARTBEAT = 2
+METRICS = {"temp": TEMP, "heartbeat": HEARTBEAT}
+
+FLUSH_INTERVAL = 5.0
+# Muestras en memoria que fuerzan un flush antes de FLUSH_INTERVAL
+MAX_BUFFERED = 5000
+PRUNE_INTERVAL = 300.0
+
+# Resoluciones: (nombre, tabla, segundos por punto, retención en segundos, ventana máxima a devolver)
+RESOLUTIONS = (
+    ("raw", "TelemetryRaw", 0, 24 * 3600, 3600),
+    ("1m", "Telemetry1m", 60, 30 * 24 * 3600, 2 * 24 * 3600),
+    ("1h", "Telemetry1h", 3600, 2 * 365 * 24 * 3600, None),
+)
+
+UPSERT_ROLLUP_SQL = """
+    INSERT INTO {table} (bot_id, metric, ts, count, sum, min, max) VALUES (?,?,?,?,?,?,?)
+    ON CONFLICT (bot_id, metric, ts) DO UPDATE SET
+        count = count + excluded.count,
+        sum = sum + excluded.sum,
+        min = min(min, excluded.min),
+        max = max(max, excluded.max)
+"""
+
+
+def choose_resolution(start: float, end: float, now: float) -> str:
+    """
+        Elige la resolución más fina que todavía tiene datos desde start y que no devuelve
+        demasiados puntos para la ventana [start, end).
+    """
+    for name, _, _, retention, max_window in RESOLUTIONS:
+        if start >= now - retention and (max_window is None or end - start <= max_window):
+            return name
+    return RESOLUTIONS[-1][0]
+
+
+class TelemetryStore:
+    """
+        Series de tiempo de temperatura y heartbeat por bot.
+
+        Las muestras se acumulan en arrays en memoria y se escriben por lotes cada FLUSH_INTERVAL.
+        En el mismo commit se suman a los promedios por minuto y por hora (count/sum/min/max), así
+        que bajar de resolución solo consiste en borrar: las muestras crudas duran 24 horas, los
+        minutos 30 días y las horas dos años. El tamaño de la base queda acotado.
+    """
+
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL, max_buffered: int = MAX_BUFFERED):
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self._bot_ids = array('q')
+        self._metrics = array('b')
+        self._timestamps = array('d')
+        self._values = array('d')
+        self._last_heartbeat = dict()
+        self._flush_needed = asyncio.Event()
+        self._task = None
+        self._last_prune = 0.0
+        self.samples = 0
+        self.flushes = 0
+        self.pruned = 0
+
+    def record(self, bot_id: int, metric: int, value: float, timestamp: float = None):
+        if bot_id is None:
+            return
+        self._bot_ids.append(bot_id)
+        self._metrics.append(metric)
+        self._timestamps.append(time.time() if timestamp is None else timestamp)
+        self._values.append(value)
+        self.samples += 1
+        if len(self._timestamps) >= self.max_buffered:
+            self._flush_needed.set()
+
+    def record_heartbeat(self, bot_id: int, timestamp: float = None):
+        """
+            Registra un heartbeat. El valor guardado son los segundos desde el heartbeat anterior,
+            así el máximo por minuto/hora muestra los cortes del bot.
+        """
+        if bot_id is None:
+            return
+        now = time.time() if timestamp is None else timestamp
+        previous = self._last_heartbeat.get(bot_id)
+        self._last_heartbeat[bot_id] = now
+        if previous is not None:
+            self.record(bot_id, HEARTBEAT, now - previous, now)
+
+    async def start(self):
+        """
+            Arranca la tarea que escribe las muestras. Se llama después de database.init().
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+            Escribe lo pendiente y detiene la tarea.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+                if time.time() - self._last_prune >= PRUNE_INTERVAL:
+                    await self.prune()
+            except Exception as e:
+                print(f"Error al guardar la telemetría: {e}")
+
+    def _take_buffer(self):
+        samples = list(zip(self._bot_ids, self._metrics, self._timestamps, self._values))
+        self._bot_ids = array('q')
+        self._metrics = array('b')
+        self._timestamps = array('d')
+        self._values = array('d')
+        self._flush_needed.clear()
+        return samples
+
+    async def flush(self):
+        """
+            Escribe las muestras en memoria y las suma a las tablas por minuto y por hora.
+        """
+        samples = self._take_buffer()
+        if not samples:
+            return
+        async with database.pool.writer() as conn:
+            # Un bot pudo borrarse después de registrar sus muestras
+            c = await conn.execute("""SELECT id FROM Bots""")
+            bot_ids = {bot_id for (bot_id,) in await c.fetchall()}
+            samples = [sample for sample in samples if sample[0] in bot_ids]
+            await self._write(conn, samples)
+        self.flushes += 1
+
+    async def _write(self, conn, samples):
+        rollups = {name: dict() for name, _, step, _, _ in RESOLUTIONS if step}
+        for bot_id, metric, timestamp, value in samples:
+            for name, _, step, _, _ in RESOLUTIONS[1:]:
+                key = (bot_id, metric, int(timestamp // step * step))
+                aggregate = rollups[name].get(key)
+                if aggregate is None:
+                    rollups[name][key] = [1, value, value, value]
+                else:
+                    aggregate[0] += 1
+                    aggregate[1] += value
+                    aggregate[2] = min(aggregate[2], value)
+                    aggregate[3] = max(aggregate[3], value)
+
+        await conn.executemany("""INSERT INTO TelemetryRaw (bot_id, metric, ts, value) VALUES (?,?,?,?)""",
+                               samples)
+        for name, table, step, _, _ in RESOLUTIONS[1:]:
+            await conn.executemany(UPSERT_ROLLUP_SQL.format(table=table),
+                                   [key + tuple(aggregate) for key, aggregate in rollups[name].items()])
+
+    async def prune(self):
+        """
+            Borra lo que ya superó la retención de cada resolución.
+        """
+        now = time.time()
+        self._last_prune = now
+        async with database.pool.writer() as conn:
+            for _, table, _, retention, _ in RESOLUTIONS:
+                c = await conn.execute(f"""DELETE FROM {table} WHERE ts < ?""", (now - retention, ))
+                self.pruned += c.rowcount
+
+    async def query(self, bot_name: str, metric: int, start: float, end: float,
+                    resolution: Union[str, None] = None) -> dict:
+        """
+            Devuelve {"resolution", "points": [[ts, promedio, mínimo, máximo], ...]} de [start, end).
+
+            Si no se indica la resolución se elige con choose_resolution.
+        """
+        resolution = resolution or choose_resolution(start, end, time.time())
+        table = {name: table for name, table, _, _, _ in RESOLUTIONS}[resolution]
+        bot_id = await database.get_bot_id(bot_name)
+
+        if resolution == "raw":
+            query = f"""SELECT ts, value, value, value FROM {table}
+                        WHERE bot_id = ? AND metric = ? AND ts >= ? AND ts < ? ORDER BY ts"""
+        else:
+            query = f"""SELECT ts, sum / count, min, max FROM {table}
+                        WHERE bot_id = ? AND metric = ? AND ts >= ? AND ts < ? ORDER BY ts"""
+        async with database.pool.reader() as conn:
+            c = await conn.execute(query, (bot_id, metric, start, end))
+            points = [list(row) for row in await c.fetchall()]
+
+        if resolution == "raw":
+            # Muestras que todavía no se escribieron
+            points.extend([ts, value, value, value]
+                          for b, m, ts, value in zip(self._bot_ids, self._metrics, self._timestamps, self._values)
+                          if b == bot_id and m == metric and start <= ts < end)
+        return {"resolution": resolution, "points": points}
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self._timestamps),
+            "samples": self.samples,
+            "flushes": self.flushes,
+            "pruned": self.pruned,
+        }